@@ -0,0 +1,90 @@
+"""Compare the memory used by a library held as dicts vs. Song records.
+
+Usage: python benchmarks/bench_song_memory.py [song_count]
+
+Both libraries are decoded from the same songs.json text, so the dict
+side carries exactly what the plugin used to keep in memory. Song
+records also carry the normalized search keys, which the search index
+would otherwise have to build and hold itself, so the second pair of
+numbers measures each library together with its SearchEngine.
+"""
+import json
+import os
+import random
+import sys
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from midiplayer.search import SearchEngine, _normalize  # noqa: E402
+from midiplayer.song import Song  # noqa: E402
+
+
+def _sample_json(count):
+    rng = random.Random(0)
+    artists = [f'Artist {i}' for i in range(max(1, count // 20))]
+    songs = [{
+        'name': f'Song Title {i}',
+        'link': f'pack_{i}:song',
+        'artist': rng.sample(artists, k=min(len(artists), rng.randint(1, 2))),
+        'duration': round(rng.uniform(60, 300), 2),
+    } for i in range(count)]
+    return json.dumps(songs, ensure_ascii=False)
+
+
+class _DictSong:
+    """Adapter giving a plain dict the attributes SearchEngine reads, computing keys on the fly."""
+
+    __slots__ = ('d',)
+
+    def __init__(self, d):
+        self.d = d
+
+    name = property(lambda self: self.d['name'])
+    link = property(lambda self: self.d['link'])
+    artist = property(lambda self: self.d['artist'])
+    name_key = property(lambda self: _normalize(self.d['name']))
+    link_key = property(lambda self: _normalize(self.d['link']))
+    artist_keys = property(lambda self: [_normalize(a) for a in self.d['artist']])
+
+
+def _dict_library_with_index(text):
+    dicts = json.loads(text)
+    return dicts, SearchEngine([_DictSong(d) for d in dicts])
+
+
+def _song_library_with_index(text):
+    songs = [Song.from_dict(d) for d in json.loads(text)]
+    return songs, SearchEngine(songs)
+
+
+def _measure(build, text):
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    library = build(text)
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    used = sum(stat.size_diff for stat in after.compare_to(before, 'filename'))
+    return library, used
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    text = _sample_json(count)
+    dicts, dict_bytes = _measure(json.loads, text)
+    songs, song_bytes = _measure(lambda t: [Song.from_dict(d) for d in json.loads(t)], text)
+    assert [s.to_dict() for s in songs] == dicts
+    print(f'songs:         {count}')
+    print(f'dict library:  {dict_bytes / 1024 / 1024:8.2f} MiB ({dict_bytes / count:.0f} B/song)')
+    print(f'Song library:  {song_bytes / 1024 / 1024:8.2f} MiB ({song_bytes / count:.0f} B/song, incl. search keys)')
+    print(f'ratio:         {song_bytes / dict_bytes:8.2f}')
+    del dicts, songs
+    _, dict_index_bytes = _measure(_dict_library_with_index, text)
+    _, song_index_bytes = _measure(_song_library_with_index, text)
+    print(f'dict + index:  {dict_index_bytes / 1024 / 1024:8.2f} MiB')
+    print(f'Song + index:  {song_index_bytes / 1024 / 1024:8.2f} MiB')
+    print(f'ratio:         {song_index_bytes / dict_index_bytes:8.2f}')
+
+
+if __name__ == '__main__':
+    main()
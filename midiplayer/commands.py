@@ -1,17 +1,17 @@
-import random
-import threading
-
 from mcdreforged.api.all import *
 
 from midiplayer.helpers import (
-    tr, _load_songs, _save_songs, _load_queue, _save_queue, _has_queue,
-    _fmt_duration, _info_text, _err_text, _song_text,
-    _get_page, _show_song_page, _show_queue_page, _show_search_results,
-    _find_song, _parse_multi_index, _send_help, _page_nav, _func_cmd,
+    tr, _load_songs, _load_queue, _save_queue, _has_queue,
+    _fmt_duration, _fmt_clock, _info_text, _err_text, _song_text,
+    _get_page, _cached_page, _show_song_page, _show_queue_page, _show_search_results, _show_no_match,
+    _find_song, _song_by_id, _link_of, _link_playable, _target, _selector, _playback_speed, _editor, _parse_multi_index, _send_help, _page_nav, _song_function,
     player_pages, player_pages_queue, player_current_song, player_play_mode,
-    player_paused, player_auto_next_timer, PLAY_MODES,
+    player_paused, player_clock, PLAY_MODES,
 )
 from midiplayer import helpers
+from midiplayer.playback import PlaybackClock
+from midiplayer.sessions import OBJECTIVE as SESSION_OBJECTIVE, NAME_PATTERN as SESSION_NAME, RADIO, RADIO_KEY
+from midiplayer.song import Song
 
 
 # ── helpers ──
@@ -20,20 +20,18 @@ def _tr_mode(m):
     """Translate a play mode key to localized display name."""
     return str(tr(f'mode.{m}'))
 
-def _get_song_duration(songs, link):
-    song = next((s for s in songs if s['link'] == link), None)
-    return song.get('duration') if song else None
+def _get_song_duration(songs, song_id):
+    _, song = _song_by_id(song_id)
+    return song.duration if song else None
 
 
 def _show_now_playing(source, songs, queue, current_idx):
     """Show prev/current/next using unified _song_text format."""
     for offset, label in [(-1, str(tr('label.prev'))), (0, None), (1, str(tr('label.next')))]:
         idx = (current_idx + offset) % len(queue)
-        link = queue[idx]
-        song = next((s for s in songs if s['link'] == link), None)
+        global_idx, song = _song_by_id(queue[idx])
         if not song:
             continue
-        global_idx = next((i for i, s in enumerate(songs) if s['link'] == link), idx)
         is_current = offset == 0
         prefix = f'§7{label}: ' if label else ''
         line = _song_text(global_idx + 1, song, highlight=is_current)
@@ -43,15 +41,51 @@ def _show_now_playing(source, songs, queue, current_idx):
             source.reply(line)
 
 
-def _play_song_and_timer(server, player, song, songs, _msgs=None):
-    """Play a song and start auto-next timer if duration available."""
+def _play_song_and_timer(server, target, song, _msgs=None, remember=True):
+    """Play a song and start auto-next timer if duration available.
+
+    remember=False keeps it out of the play history (used by prev).
+    """
     from midiplayer.midiplayer import _start_auto_next
-    server.execute(f'execute as {player} run function {_func_cmd(song["link"], "play")}')
-    player_current_song[player] = song['link']
-    player_paused[player] = False
-    dur = song.get('duration')
-    if dur:
-        _start_auto_next(server, player, dur, songs, _msgs=_msgs)
+    _song_function(_selector(target), song.link, 'play')
+    player_current_song[target] = song.id
+    _load_queue(target).played(song.id, remember)
+    player_paused[target] = False
+    clock = player_clock[target] = PlaybackClock(song.duration, speed=_playback_speed())
+    if song.duration:
+        _start_auto_next(server, target, clock.wall_remaining(), _msgs=_msgs)
+
+
+def _resume_song(server, target, song):
+    """Continue a paused song and re-arm auto-next for the time it has left."""
+    from midiplayer.midiplayer import _start_auto_next
+    clock = player_clock.get(target)
+    if clock is None:
+        # no position to continue from (e.g. restored after rejoining)
+        _play_song_and_timer(server, target, song)
+        return
+    _song_function(_selector(target), song.link, 'play')
+    player_paused[target] = False
+    clock.resume()
+    remaining = clock.wall_remaining()
+    if remaining is not None:
+        _start_auto_next(server, target, remaining)
+
+
+def _check_link(source, song):
+    """Refuse a song whose play function is not in the world's datapacks."""
+    if _link_playable(song.link):
+        return True
+    source.reply(_err_text(str(tr('msg.link_missing', song.name, song.link))))
+    return False
+
+
+def _radio_locked(source, target):
+    """The radio runs on its own; listeners can look at it but not steer it."""
+    if target != RADIO_KEY:
+        return False
+    source.reply(_err_text(str(tr('msg.radio_locked'))))
+    return True
 
 
 def _validate_page(page, total_pages):
@@ -71,11 +105,11 @@ def cmd_list(source: CommandSource, context=None):
     player = source.player if source.is_player else None
     if not player:
         return
-    songs = _load_songs()
-    if not songs:
+    total = helpers.catalog.count()
+    if not total:
         source.reply(_err_text(str(tr('msg.no_songs'))))
         return
-    total_pages = max(1, (len(songs) + helpers.items_per_page - 1) // helpers.items_per_page)
+    total_pages = max(1, (total + helpers.items_per_page - 1) // helpers.items_per_page)
     if context and 'page' in context:
         p = _validate_page(context['page'], total_pages)
         if p is None:
@@ -84,20 +118,20 @@ def cmd_list(source: CommandSource, context=None):
         player_pages[player] = p
     elif player not in player_pages:
         player_pages[player] = 1
-    page, start, end, total_pages = _get_page(songs, player, player_pages)
-    _show_song_page(source, songs, page, start, end, total_pages)
+    page, start, end, total_pages = _get_page(total, player, player_pages)
+    _show_song_page(source, page, start, end, total_pages)
 
 
 def cmd_links(source: CommandSource, context=None):
     player = source.player if source.is_player else None
     if not player:
         return
-    songs = _load_songs()
-    if not songs:
+    total = helpers.catalog.count()
+    if not total:
         source.reply(_err_text(str(tr('msg.no_songs'))))
         return
     if context and 'page' in context:
-        total_pages = max(1, (len(songs) + helpers.items_per_page - 1) // helpers.items_per_page)
+        total_pages = max(1, (total + helpers.items_per_page - 1) // helpers.items_per_page)
         p = _validate_page(context['page'], total_pages)
         if p is None:
             source.reply(_err_text(str(tr('msg.invalid_page'))))
@@ -105,110 +139,114 @@ def cmd_links(source: CommandSource, context=None):
         player_pages[player] = p
     elif player not in player_pages:
         player_pages[player] = 1
-    page, start, end, total_pages = _get_page(songs, player, player_pages)
-    source.reply(_info_text(str(tr('msg.page_info', page, total_pages))))
-    for idx in range(start, end):
-        song = songs[idx]
-        source.reply(RTextList(
-            RText(f'{idx + 1}. ', color=RColor.gray),
-            RText(song['name'], color=RColor.green),
-            RText(f' : {song["link"]}', color=RColor.gray),
-        ))
-    source.reply(_page_nav(page, total_pages, '!!mp links'))
+    page, start, end, total_pages = _get_page(total, player, player_pages)
+
+    def render():
+        lines = [_info_text(str(tr('msg.page_info', page, total_pages)))]
+        for idx, song in enumerate(helpers.catalog.page(start, end), start):
+            lines.append(RTextList(
+                RText(f'{idx + 1}. ', color=RColor.gray),
+                RText(song.name, color=RColor.green),
+                RText(f' : {song.link}', color=RColor.gray),
+            ))
+        lines.append(_page_nav(page, total_pages, '!!mp links'))
+        return lines
+
+    for line in _cached_page('!!mp links', page, render):
+        source.reply(line)
 
 
 def cmd_search(source: CommandSource, context):
     player = source.player if source.is_player else None
     if not player:
         return
-    raw = context['keyword']
-    keyword = raw.replace('_', ' ')
-    songs = _load_songs()
-    matches = [
-        (i, s) for i, s in enumerate(songs)
-        if keyword.lower() in s['name'].lower()
-        or raw.lower() in s['name'].lower()
-        or raw.lower() in s.get('link', '').lower()
-        or any(keyword.lower() in a.lower() for a in s['artist'])
-    ]
+    matches = helpers.catalog.search_engine().search(context['keyword'])
     if matches:
         _show_search_results(source, matches)
     else:
-        source.reply(_err_text(str(tr('msg.no_match'))))
+        _show_no_match(source, context['keyword'])
 
 
 def cmd_play(source: CommandSource, context=None):
     player = source.player if source.is_player else None
     if not player:
         return
+    target = _target(player)
+    if _radio_locked(source, target):
+        return
     server = source.get_server()
     songs = _load_songs()
 
     # !!mp play without args — play current or first in queue
     if context is None or 'keyword' not in context:
-        current = player_current_song.get(player)
-        if current:
-            song = next((s for s in songs if s['link'] == current), None)
-            song_name = song['name'] if song else current
-            source.reply(_info_text(str(tr('msg.resumed', song_name))))
-            if song:
-                _play_song_and_timer(server, player, song, songs)
+        _, song = _song_by_id(player_current_song.get(target))
+        if song:
+            if not _check_link(source, song):
+                return
+            source.reply(_info_text(str(tr('msg.resumed', song.name))))
+            if player_paused.get(target):
+                _resume_song(server, target, song)
             else:
-                server.execute(f'execute as {player} run function {_func_cmd(current, "play")}')
+                _play_song_and_timer(server, target, song)
         else:
-            queue = _load_queue(player)
+            queue = _load_queue(target)
             if queue:
-                song = next((s for s in songs if s['link'] == queue[0]), None)
-                if song:
-                    source.reply(_info_text(str(tr('msg.playing', song['name']))))
-                    _play_song_and_timer(server, player, song, songs)
+                _, song = _song_by_id(queue[0])
+                if song and _check_link(source, song):
+                    source.reply(_info_text(str(tr('msg.playing', song.name))))
+                    _play_song_and_timer(server, target, song)
             else:
                 source.reply(_err_text(str(tr('msg.queue_empty'))))
         return
 
     raw = context['keyword']
     user_input = raw.replace('_', ' ')
-    queue = _load_queue(player)
+    queue = _load_queue(target)
     result = _find_song(songs, user_input, raw)
 
     if result is None:
-        source.reply(_err_text(str(tr('msg.no_match'))))
+        _show_no_match(source, context['keyword'])
         return
     if isinstance(result, list):
         _show_search_results(source, result)
         return
 
     song, _ = result
-    if song['link'] not in queue:
-        queue.append(song['link'])
-        _save_queue(player, queue)
-    if player in player_current_song:
-        server.execute(f'execute as {player} run function {_func_cmd(player_current_song[player], "stop")}')
+    if not _check_link(source, song):
+        return
+    if queue.append(song.id):
+        _save_queue(target, queue)
+    current = _link_of(player_current_song.get(target))
+    if current:
+        _song_function(_selector(target), current, 'stop')
     source.reply(RTextList(
-        _info_text(str(tr('msg.found_song', song['name'], ', '.join(song['artist'])))),
+        _info_text(str(tr('msg.found_song', song.name, ', '.join(song.artist)))),
     ))
-    source.reply(_info_text(str(tr('msg.playing', song['name']))))
-    _play_song_and_timer(server, player, song, songs)
+    source.reply(_info_text(str(tr('msg.playing', song.name))))
+    _play_song_and_timer(server, target, song)
 
 
 def cmd_stop(source: CommandSource):
     player = source.player if source.is_player else None
     if not player:
         return
+    target = _target(player)
+    if _radio_locked(source, target):
+        return
     server = source.get_server()
     from midiplayer.midiplayer import _cancel_auto_next
-    _cancel_auto_next(player)
-    if not _has_queue(player):
+    _cancel_auto_next(target)
+    if not _has_queue(target):
         source.reply(_err_text(str(tr('msg.queue_empty'))))
         return
-    current = player_current_song.get(player)
-    if current:
-        server.execute(f'execute as {player} run function {_func_cmd(current, "pause")}')
-        player_paused[player] = True
-        songs = _load_songs()
-        song = next((s for s in songs if s['link'] == current), None)
-        song_name = song['name'] if song else current
-        source.reply(_info_text(str(tr('msg.paused', song_name))))
+    _, song = _song_by_id(player_current_song.get(target))
+    if song:
+        _song_function(_selector(target), song.link, 'pause')
+        player_paused[target] = True
+        clock = player_clock.get(target)
+        if clock:
+            clock.pause()
+        source.reply(_info_text(str(tr('msg.paused', song.name))))
     else:
         source.reply(_info_text(str(tr('msg.paused', '?'))))
 
@@ -217,18 +255,17 @@ def cmd_resume(source: CommandSource):
     player = source.player if source.is_player else None
     if not player:
         return
+    target = _target(player)
+    if _radio_locked(source, target):
+        return
     server = source.get_server()
-    if not _has_queue(player):
+    if not _has_queue(target):
         source.reply(_err_text(str(tr('msg.queue_empty'))))
         return
-    current = player_current_song.get(player)
-    if current:
-        server.execute(f'execute as {player} run function {_func_cmd(current, "play")}')
-        player_paused[player] = False
-        songs = _load_songs()
-        song = next((s for s in songs if s['link'] == current), None)
-        song_name = song['name'] if song else current
-        source.reply(_info_text(str(tr('msg.resumed', song_name))))
+    _, song = _song_by_id(player_current_song.get(target))
+    if song:
+        _resume_song(server, target, song)
+        source.reply(_info_text(str(tr('msg.resumed', song.name))))
     else:
         source.reply(_info_text(str(tr('msg.resumed', '?'))))
 
@@ -237,22 +274,25 @@ def cmd_now(source: CommandSource):
     player = source.player if source.is_player else None
     if not player:
         return
-    mode = player_play_mode.get(player, 'sequential')
-    current = player_current_song.get(player)
+    target = _target(player)
+    mode = player_play_mode.get(target, 'sequential')
+    current = player_current_song.get(target)
     if not current:
         source.reply(_err_text(str(tr('msg.no_current_song'))))
         source.reply(_info_text(str(tr('msg.current_mode', _tr_mode(mode)))))
         return
-    songs = _load_songs()
-    song = next((s for s in songs if s['link'] == current), None)
+    global_idx, song = _song_by_id(current)
     if song:
-        global_idx = next((i for i, s in enumerate(songs) if s['link'] == current), 0)
         source.reply(_song_text(global_idx + 1, song, highlight=True))
     else:
-        source.reply(_info_text(str(tr('msg.now_playing', current, '', ''))))
+        source.reply(_info_text(str(tr('msg.now_playing', f'#{current}', '', ''))))
+    clock = player_clock.get(target)
+    if clock:
+        source.reply(_info_text(str(tr('msg.now_position', _fmt_clock(clock.position()),
+                                       _fmt_clock(clock.duration), _fmt_clock(clock.remaining())))))
     source.reply(_info_text(str(tr('msg.current_mode', _tr_mode(mode)))))
     # playback controls: ⏮  ⏸/▶  ⏭
-    is_paused = player_paused.get(player, False)
+    is_paused = player_paused.get(target, False)
     if is_paused:
         mid_btn = RText(' ▶ ', color=RColor.green).c(RAction.suggest_command, '!!mp resume').h(str(tr('label.resume')))
     else:
@@ -269,9 +309,12 @@ def cmd_mode(source: CommandSource, context=None):
     player = source.player if source.is_player else None
     if not player:
         return
+    target = _target(player)
+    if _radio_locked(source, target):
+        return
     # no args: show current mode + clickable options
     if context is None or 'keyword' not in context:
-        current_mode = player_play_mode.get(player, 'sequential')
+        current_mode = player_play_mode.get(target, 'sequential')
         source.reply(_info_text(str(tr('msg.current_mode', _tr_mode(current_mode)))))
         btns = []
         for m in PLAY_MODES:
@@ -287,7 +330,7 @@ def cmd_mode(source: CommandSource, context=None):
     if mode not in PLAY_MODES:
         source.reply(_err_text(str(tr('msg.invalid_mode'))))
         return
-    player_play_mode[player] = mode
+    player_play_mode[target] = mode
     source.reply(_info_text(str(tr('msg.mode_set', _tr_mode(mode)))))
 
 
@@ -295,97 +338,104 @@ def cmd_next(source: CommandSource):
     player = source.player if source.is_player else None
     if not player:
         return
+    target = _target(player)
+    if _radio_locked(source, target):
+        return
     server = source.get_server()
     from midiplayer.midiplayer import _cancel_auto_next
-    _cancel_auto_next(player)
+    _cancel_auto_next(target)
     songs = _load_songs()
-    queue = _load_queue(player)
+    queue = _load_queue(target)
     if not queue:
         source.reply(_err_text(str(tr('msg.queue_empty'))))
         return
     if len(queue) == 1:
         source.reply(_err_text(str(tr('msg.queue_one_song_no_next'))))
         return
-    current = player_current_song.get(player)
-    if current:
-        server.execute(f'execute as {player} run function {_func_cmd(current, "stop")}')
+    current = player_current_song.get(target)
+    current_link = _link_of(current)
+    if current_link:
+        _song_function(_selector(target), current_link, 'stop')
 
-    mode = player_play_mode.get(player, 'sequential')
+    mode = player_play_mode.get(target, 'sequential')
     if mode == 'random':
-        candidates = [q for q in queue if q != current]
-        if not candidates:
-            candidates = list(queue)
-        link = random.choice(candidates)
+        song_id = queue.draw()
+        idx = queue.index(song_id)
     else:
-        if current and current in queue:
-            idx = (queue.index(current) + 1) % len(queue)
-        else:
-            idx = 0
-        link = queue[idx]
-
-    idx = queue.index(link) if link in queue else 0
-    song = next((s for s in songs if s['link'] == link), None)
-    if song:
-        source.reply(_info_text(str(tr('msg.next_playing', song['name']))))
-        _play_song_and_timer(server, player, song, songs)
+        idx = queue.locate(current)
+        idx = 0 if idx is None else (idx + 1) % len(queue)
+        song_id = queue[idx]
+
+    _, song = _song_by_id(song_id)
+    if song and _check_link(source, song):
+        source.reply(_info_text(str(tr('msg.next_playing', song.name))))
+        _play_song_and_timer(server, target, song)
         _show_now_playing(source, songs, queue, idx)
     else:
-        player_current_song[player] = link
-        server.execute(f'execute as {player} run function {_func_cmd(link, "play")}')
+        # deleted from the library or not in a loaded datapack; step over it on the next next/prev
+        player_current_song[target] = song_id
+        queue.seek(song_id)
 
 
 def cmd_prev(source: CommandSource):
     player = source.player if source.is_player else None
     if not player:
         return
+    target = _target(player)
+    if _radio_locked(source, target):
+        return
     server = source.get_server()
     from midiplayer.midiplayer import _cancel_auto_next
-    _cancel_auto_next(player)
+    _cancel_auto_next(target)
     songs = _load_songs()
-    queue = _load_queue(player)
+    queue = _load_queue(target)
     if not queue:
         source.reply(_err_text(str(tr('msg.queue_empty'))))
         return
     if len(queue) == 1:
         source.reply(_err_text(str(tr('msg.queue_one_song_no_prev'))))
         return
-    current = player_current_song.get(player)
-    if current:
-        server.execute(f'execute as {player} run function {_func_cmd(current, "stop")}')
+    current = player_current_song.get(target)
+    current_link = _link_of(current)
+    if current_link:
+        _song_function(_selector(target), current_link, 'stop')
 
-    mode = player_play_mode.get(player, 'sequential')
-    if mode == 'random':
-        candidates = [q for q in queue if q != current]
-        if not candidates:
-            candidates = list(queue)
-        link = random.choice(candidates)
-        idx = queue.index(link) if link in queue else 0
+    mode = player_play_mode.get(target, 'sequential')
+    remember = True
+    if mode == 'random' and len(queue.history) >= 2:
+        # go back to what actually played before the current song
+        queue.history.pop()
+        song_id = queue.history[-1]
+        remember = False
     else:
-        if current and current in queue:
-            idx = (queue.index(current) - 1) % len(queue)
-        else:
-            idx = 0
-    link = queue[idx]
-    song = next((s for s in songs if s['link'] == link), None)
-    if song:
-        source.reply(_info_text(str(tr('msg.prev_playing', song['name']))))
-        _play_song_and_timer(server, player, song, songs)
-        _show_now_playing(source, songs, queue, idx)
+        idx = queue.locate(current)
+        idx = 0 if idx is None else (idx - 1) % len(queue)
+        song_id = queue[idx]
+    _, song = _song_by_id(song_id)
+    if song and _check_link(source, song):
+        source.reply(_info_text(str(tr('msg.prev_playing', song.name))))
+        _play_song_and_timer(server, target, song, remember=remember)
+        if song_id in queue:
+            _show_now_playing(source, songs, queue, queue.index(song_id))
     else:
-        player_current_song[player] = link
-        server.execute(f'execute as {player} run function {_func_cmd(link, "play")}')
+        # deleted from the library or not in a loaded datapack; step over it on the next next/prev
+        player_current_song[target] = song_id
+        queue.seek(song_id)
 
 
 def cmd_shuffle(source: CommandSource):
     player = source.player if source.is_player else None
     if not player:
         return
-    if not _has_queue(player):
+    target = _target(player)
+    if _radio_locked(source, target):
+        return
+    if not _has_queue(target):
         source.reply(_err_text(str(tr('msg.queue_empty'))))
         return
-    queue = _load_queue(player)
-    random.shuffle(queue)
-    _save_queue(player, queue)
+    queue = _load_queue(target)
+    queue.shuffle()
+    _save_queue(target, queue)
     source.reply(_info_text(str(tr('msg.queue_shuffled'))))
 
 
@@ -393,10 +443,13 @@ def cmd_add_to_queue(source: CommandSource, context):
     player = source.player if source.is_player else None
     if not player:
         return
+    target = _target(player)
+    if _radio_locked(source, target):
+        return
     songs = _load_songs()
     raw = context['keyword']
     user_input = raw.replace('_', ' ')
-    queue = _load_queue(player)
+    queue = _load_queue(target)
 
     # try multi-index
     if ',' in user_input or ('-' in user_input and not user_input.replace('-', '').replace(',', '').replace(' ', '').isalpha()):
@@ -406,27 +459,25 @@ def cmd_add_to_queue(source: CommandSource, context):
         else:
             for i in indexes:
                 song = songs[i]
-                if song['link'] not in queue:
-                    queue.append(song['link'])
-                    source.reply(_info_text(str(tr('msg.added_to_queue', song['name']))))
+                if queue.append(song.id):
+                    source.reply(_info_text(str(tr('msg.added_to_queue', song.name))))
                 else:
                     source.reply(_err_text(str(tr('msg.already_in_queue'))))
-            _save_queue(player, queue)
+            _save_queue(target, queue)
         return
 
     result = _find_song(songs, user_input, raw)
     if result is None:
-        source.reply(_err_text(str(tr('msg.no_match'))))
+        _show_no_match(source, context['keyword'])
         return
     if isinstance(result, list):
         _show_search_results(source, result)
         return
 
     song, _ = result
-    if song['link'] not in queue:
-        queue.append(song['link'])
-        _save_queue(player, queue)
-        source.reply(_info_text(str(tr('msg.added_to_queue', song['name']))))
+    if queue.append(song.id):
+        _save_queue(target, queue)
+        source.reply(_info_text(str(tr('msg.added_to_queue', song.name))))
     else:
         source.reply(_err_text(str(tr('msg.already_in_queue'))))
 
@@ -435,7 +486,8 @@ def cmd_queue(source: CommandSource, context=None):
     player = source.player if source.is_player else None
     if not player:
         return
-    queue = _load_queue(player)
+    target = _target(player)
+    queue = _load_queue(target)
     if not queue:
         source.reply(_err_text(str(tr('msg.queue_empty'))))
         return
@@ -449,25 +501,21 @@ def cmd_queue(source: CommandSource, context=None):
         player_pages_queue[player] = p
     elif player not in player_pages_queue:
         player_pages_queue[player] = 1
-    page, start, end, total_pages = _get_page(queue, player, player_pages_queue)
-    current_link = player_current_song.get(player)
-    _show_queue_page(source, queue, songs, page, start, end, total_pages, current_link)
+    page, start, end, total_pages = _get_page(len(queue), player, player_pages_queue)
+    _show_queue_page(source, queue, songs, page, start, end, total_pages, player_current_song.get(target))
 
 
 def cmd_queue_search(source: CommandSource, context):
     player = source.player if source.is_player else None
     if not player:
         return
-    raw = context['keyword']
-    keyword = raw.replace('_', ' ')
-    queue = _load_queue(player)
-    songs = _load_songs()
+    target = _target(player)
+    queue = _load_queue(target)
+    matched = {i for tier in helpers.catalog.search_engine().search_tiers(context['keyword']) for i in tier}
     matches = []
-    for _qi, link in enumerate(queue):
-        song = next((s for s in songs if s['link'] == link), None)
-        if song and (keyword.lower() in song['name'].lower() or raw.lower() in song['name'].lower() or raw.lower() in link.lower() or any(keyword.lower() in a.lower() for a in song['artist'])):
-            # use global song index so !!mp play <idx> targets the correct song
-            global_idx = next((i for i, s in enumerate(songs) if s['link'] == link), _qi)
+    for song_id in queue:
+        global_idx, song = _song_by_id(song_id)
+        if song and global_idx in matched:
             matches.append((global_idx, song))
     if matches:
         source.reply(_info_text(str(tr('msg.found_songs', len(matches)))))
@@ -481,10 +529,13 @@ def cmd_remove_from_queue(source: CommandSource, context):
     player = source.player if source.is_player else None
     if not player:
         return
+    target = _target(player)
+    if _radio_locked(source, target):
+        return
     songs = _load_songs()
     raw = context['keyword']
     user_input = raw.replace('_', ' ')
-    queue = _load_queue(player)
+    queue = _load_queue(target)
     if not queue:
         source.reply(_err_text(str(tr('msg.queue_empty'))))
         return
@@ -496,26 +547,23 @@ def cmd_remove_from_queue(source: CommandSource, context):
             source.reply(_err_text(str(tr('msg.invalid_range'))))
         else:
             for i in indexes:
-                link = songs[i]['link']
-                if link in queue:
-                    queue.remove(link)
-                    source.reply(_info_text(str(tr('msg.removed_from_queue', songs[i]['name']))))
-            _save_queue(player, queue)
+                if queue.remove(songs[i].id):
+                    source.reply(_info_text(str(tr('msg.removed_from_queue', songs[i].name))))
+            _save_queue(target, queue)
         return
 
     result = _find_song(songs, user_input, raw)
     if result is None:
-        source.reply(_err_text(str(tr('msg.no_match'))))
+        _show_no_match(source, context['keyword'])
         return
     if isinstance(result, list):
         _show_search_results(source, result)
         return
 
     song, _ = result
-    if song['link'] in queue:
-        queue.remove(song['link'])
-        _save_queue(player, queue)
-        source.reply(_info_text(str(tr('msg.removed_from_queue', song['name']))))
+    if queue.remove(song.id):
+        _save_queue(target, queue)
+        source.reply(_info_text(str(tr('msg.removed_from_queue', song.name))))
     else:
         source.reply(_err_text(str(tr('msg.not_in_queue'))))
 
@@ -524,17 +572,167 @@ def cmd_clear(source: CommandSource):
     player = source.player if source.is_player else None
     if not player:
         return
+    target = _target(player)
+    if _radio_locked(source, target):
+        return
     server = source.get_server()
     from midiplayer.midiplayer import _cancel_auto_next
-    _cancel_auto_next(player)
-    current = player_current_song.get(player)
+    _cancel_auto_next(target)
+    current = _link_of(player_current_song.get(target))
     if current:
-        server.execute(f'execute as {player} run function {_func_cmd(current, "stop")}')
-    _save_queue(player, [])
-    player_current_song.pop(player, None)
+        _song_function(_selector(target), current, 'stop')
+    _save_queue(target, [])
+    player_current_song.pop(target, None)
     source.reply(_info_text(str(tr('msg.queue_cleared'))))
 
 
+# ── sessions ──
+
+def _join_session(server, player, session):
+    """Attach ``player`` to ``session``, parking their own playback."""
+    from midiplayer.midiplayer import _cancel_auto_next
+    if helpers.sessions.of(player) is None:
+        _cancel_auto_next(player)
+        current = _link_of(player_current_song.get(player))
+        if current and not player_paused.get(player):
+            _song_function(player, current, 'pause')
+            player_paused[player] = True
+            clock = player_clock.get(player)
+            if clock:
+                clock.pause()
+    else:
+        _leave_session(server, player)
+    helpers.sessions.join(player, session)
+    server.execute(f'scoreboard players set {player} {SESSION_OBJECTIVE} {session.number}')
+
+
+def _leave_session(server, player, online=True):
+    """Detach ``player`` from their session; the last one out closes it.
+
+    Returns the session they left, or None.
+    """
+    from midiplayer.midiplayer import _cancel_auto_next
+    session, closed = helpers.sessions.leave(player)
+    if session is None:
+        return None
+    # scores are kept by name, so this works for players who already left the game
+    server.execute(f'scoreboard players reset {player} {SESSION_OBJECTIVE}')
+    current = _link_of(player_current_song.get(session.key))
+    if online and current:
+        _song_function(player, current, 'stop')
+    if closed:
+        _cancel_auto_next(session.key)
+        helpers._forget_player(session.key)
+        if session.key == RADIO_KEY:
+            helpers.queues.left(session.key)  # the rotation is kept in sync with the library
+        else:
+            helpers.queues.drop(session.key)  # a later session with this name starts empty
+    return session
+
+
+def cmd_session(source: CommandSource):
+    player = source.player if source.is_player else None
+    session = helpers.sessions.of(player) if player else None
+    if session:
+        source.reply(_info_text(str(tr('msg.session_current', session.name, len(session.members)))))
+    if not len(helpers.sessions):
+        source.reply(_info_text(str(tr('msg.session_none'))))
+        return
+    source.reply(_info_text(str(tr('msg.session_list', len(helpers.sessions)))))
+    for s in helpers.sessions:
+        _, song = _song_by_id(player_current_song.get(s.key))
+        owner = s.owner or str(tr('label.server'))
+        line = RText(f'  {s.name} ', color=RColor.aqua if s is session else RColor.green)
+        line.c(RAction.suggest_command, f'!!mp session join {s.name}').h(str(tr('hover.session_join', s.name)))
+        source.reply(RTextList(line, RText(str(tr('msg.session_entry', owner, len(s.members), song.name if song else '-')), color=RColor.gray)))
+
+
+def cmd_session_create(source: CommandSource, context):
+    player = source.player if source.is_player else None
+    if not player:
+        return
+    name = context['session_name']
+    if not SESSION_NAME.fullmatch(name) or name == RADIO:
+        source.reply(_err_text(str(tr('msg.session_invalid_name'))))
+        return
+    session = helpers.sessions.create(name, player)
+    if session is None:
+        source.reply(_err_text(str(tr('msg.session_exists', name))))
+        return
+    helpers.queues.drop(session.key)  # left behind if the plugin stopped with the session open
+    helpers.queues.joined(session.key)
+    _join_session(source.get_server(), player, session)
+    source.reply(_info_text(str(tr('msg.session_created', name))))
+
+
+def cmd_session_join(source: CommandSource, context):
+    player = source.player if source.is_player else None
+    if not player:
+        return
+    name = context['session_name']
+    if name == RADIO:
+        _tune_in(source, player)
+        return
+    session = helpers.sessions.get(name)
+    if session is None:
+        source.reply(_err_text(str(tr('msg.session_not_found', name))))
+        return
+    if helpers.sessions.of(player) is session:
+        source.reply(_err_text(str(tr('msg.session_already_in', name))))
+        return
+    _join_session(source.get_server(), player, session)
+    source.reply(_info_text(str(tr('msg.session_joined', name, len(session.members)))))
+
+
+def cmd_session_leave(source: CommandSource):
+    player = source.player if source.is_player else None
+    if not player:
+        return
+    session = _leave_session(source.get_server(), player)
+    if session is None:
+        source.reply(_err_text(str(tr('msg.session_not_in'))))
+        return
+    source.reply(_info_text(str(tr('msg.session_left', session.name))))
+
+
+# ── radio ──
+
+def _tune_in(source, player):
+    server = source.get_server()
+    radio = helpers.sessions.get(RADIO)
+    if radio is None:
+        if not _load_queue(RADIO_KEY):
+            if helpers.radio_tag:
+                source.reply(_err_text(str(tr('msg.radio_tag_empty', helpers.radio_tag))))
+            else:
+                source.reply(_err_text(str(tr('msg.radio_empty'))))
+            return
+        radio = helpers.sessions.create(RADIO, None)
+        helpers.queues.joined(RADIO_KEY)
+        player_play_mode[RADIO_KEY] = helpers.radio_mode
+    _join_session(server, player, radio)
+    task = helpers.scheduler.get(RADIO_KEY)
+    if task is None or not task.is_alive():
+        # first listener: the channel's one auto-next task picks the first song
+        from midiplayer.midiplayer import _start_auto_next
+        _start_auto_next(server, RADIO_KEY, 0)
+        source.reply(_info_text(str(tr('msg.radio_on', len(radio.members)))))
+    else:
+        # joining mid-song: the next song is the first one they hear
+        source.reply(_info_text(str(tr('msg.radio_on_next', len(radio.members), _fmt_clock(task.remaining())))))
+
+
+def cmd_radio(source: CommandSource):
+    player = source.player if source.is_player else None
+    if not player:
+        return
+    if _target(player) == RADIO_KEY:
+        _leave_session(source.get_server(), player)
+        source.reply(_info_text(str(tr('msg.radio_off'))))
+    else:
+        _tune_in(source, player)
+
+
 # ── admin commands ──
 
 def cmd_admin_add(source: CommandSource, context):
@@ -542,9 +740,7 @@ def cmd_admin_add(source: CommandSource, context):
     artists_str = context['song_artists'].replace('_', ' ')
     link = context['song_link']
     artists = [a.strip() for a in artists_str.split(',')]
-    songs = _load_songs()
-    songs.append({'name': name, 'link': link, 'artist': artists})
-    _save_songs(songs)
+    helpers.catalog.append(Song(name, link, artists), by=_editor(source))
     source.reply(_info_text(str(tr('msg.song_added', name))))
 
 
@@ -552,8 +748,7 @@ def cmd_admin_del(source: CommandSource, context):
     idx = context['index'] - 1
     songs = _load_songs()
     if 0 <= idx < len(songs):
-        songs.pop(idx)
-        _save_songs(songs)
+        helpers.catalog.pop(idx, by=_editor(source))
         source.reply(_info_text(str(tr('msg.song_deleted'))))
     else:
         source.reply(_err_text(str(tr('msg.invalid_index'))))
@@ -563,8 +758,7 @@ def cmd_admin_copy(source: CommandSource, context):
     idx = context['index'] - 1
     songs = _load_songs()
     if 0 <= idx < len(songs):
-        songs.append(songs[idx].copy())
-        _save_songs(songs)
+        helpers.catalog.append(songs[idx].copy(), by=_editor(source))
         source.reply(_info_text(str(tr('msg.song_copied'))))
     else:
         source.reply(_err_text(str(tr('msg.invalid_index'))))
@@ -574,8 +768,7 @@ def cmd_admin_set_name(source: CommandSource, context):
     idx = context['index'] - 1
     songs = _load_songs()
     if 0 <= idx < len(songs):
-        songs[idx]['name'] = context['song_name'].replace('_', ' ')
-        _save_songs(songs)
+        helpers.catalog.update(idx, by=_editor(source), name=context['song_name'].replace('_', ' '))
         source.reply(_info_text(str(tr('msg.name_edited'))))
     else:
         source.reply(_err_text(str(tr('msg.invalid_index'))))
@@ -585,8 +778,7 @@ def cmd_admin_set_artist(source: CommandSource, context):
     idx = context['index'] - 1
     songs = _load_songs()
     if 0 <= idx < len(songs):
-        songs[idx]['artist'] = [a.strip() for a in context['song_artists'].replace('_', ' ').split(',')]
-        _save_songs(songs)
+        helpers.catalog.update(idx, by=_editor(source), artist=[a.strip() for a in context['song_artists'].replace('_', ' ').split(',')])
         source.reply(_info_text(str(tr('msg.artist_edited'))))
     else:
         source.reply(_err_text(str(tr('msg.invalid_index'))))
@@ -596,8 +788,7 @@ def cmd_admin_set_link(source: CommandSource, context):
     idx = context['index'] - 1
     songs = _load_songs()
     if 0 <= idx < len(songs):
-        songs[idx]['link'] = context['song_link']
-        _save_songs(songs)
+        helpers.catalog.update(idx, by=_editor(source), link=context['song_link'])
         source.reply(_info_text(str(tr('msg.link_edited'))))
     else:
         source.reply(_err_text(str(tr('msg.invalid_index'))))
@@ -605,55 +796,80 @@ def cmd_admin_set_link(source: CommandSource, context):
 
 def cmd_admin_info(source: CommandSource, context=None):
     """!!mpa info [page] — show song details with editable fields."""
-    songs = _load_songs()
-    if not songs:
+    total = helpers.catalog.count()
+    if not total:
         source.reply(_err_text(str(tr('msg.no_songs'))))
         return
     page = context.get('page', 1) if context else 1
     per_page = getattr(helpers, 'items_per_page', 8)
-    total_pages = max(1, (len(songs) + per_page - 1) // per_page)
+    total_pages = max(1, (total + per_page - 1) // per_page)
     if page < 1 or page > total_pages:
         source.reply(_err_text(str(tr('msg.invalid_page'))))
         return
     start = (page - 1) * per_page
-    end = min(start + per_page, len(songs))
-    source.reply(_info_text(str(tr('msg.page_info', page, total_pages))))
-    for i in range(start, end):
-        s = songs[i]
-        idx = i + 1
-        name = s.get('name', '?')
-        artist = ', '.join(s.get('artist', ['?']))
-        link = s.get('link', '?')
-        dur = s.get('duration')
-        dur_str = _fmt_duration(dur) if dur else '?'
-        line = RTextList(
-            RText(f'{idx}. ', color=RColor.gold),
-            RText(name, color=RColor.green)
-                .c(RAction.suggest_command, f'!!mpa set {idx} name ')
-                .h(str(tr('hover.edit_name'))),
-            RText(f' - ', color=RColor.dark_gray),
-            RText(artist, color=RColor.gray)
-                .c(RAction.suggest_command, f'!!mpa set {idx} artist ')
-                .h(str(tr('hover.edit_artist'))),
-            RText(f' [', color=RColor.dark_gray),
-            RText(dur_str, color=RColor.aqua)
-                .c(RAction.suggest_command, f'!!mpa set {idx} duration ')
-                .h(str(tr('hover.edit_duration'))),
-            RText(f']', color=RColor.dark_gray),
-            RText(f' ', color=RColor.dark_gray),
-            RText(link, color=RColor.yellow)
-                .c(RAction.suggest_command, f'!!mpa set {idx} link ')
-                .h(str(tr('hover.edit_link'))),
-            RText(' [©]', color=RColor.aqua)
-                .c(RAction.suggest_command, f'!!mpa copy {idx}')
-                .h(str(tr('hover.copy_song'))),
-            RText(' [-]', color=RColor.red)
-                .c(RAction.suggest_command, f'!!mpa del {idx}')
-                .h(str(tr('hover.delete_song'))),
-        )
+    end = min(start + per_page, total)
+
+    def render():
+        lines = [_info_text(str(tr('msg.page_info', page, total_pages)))]
+        for i, s in enumerate(helpers.catalog.page(start, end), start):
+            idx = i + 1
+            name = s.name or '?'
+            artist = ', '.join(s.artist) or '?'
+            link = s.link or '?'
+            link_ok = _link_playable(s.link)
+            dur = s.duration
+            dur_str = _fmt_duration(dur) if dur else '?'
+            line = RTextList(
+                RText(f'{idx}. ', color=RColor.gold),
+                RText(name, color=RColor.green)
+                    .c(RAction.suggest_command, f'!!mpa set {idx} name ')
+                    .h(str(tr('hover.edit_name'))),
+                RText(f' - ', color=RColor.dark_gray),
+                RText(artist, color=RColor.gray)
+                    .c(RAction.suggest_command, f'!!mpa set {idx} artist ')
+                    .h(str(tr('hover.edit_artist'))),
+                RText(f' [', color=RColor.dark_gray),
+                RText(dur_str, color=RColor.aqua)
+                    .c(RAction.suggest_command, f'!!mpa set {idx} duration ')
+                    .h(str(tr('hover.edit_duration'))),
+                RText(f']', color=RColor.dark_gray),
+                RText(f' ', color=RColor.dark_gray),
+                RText(link, color=RColor.yellow if link_ok else RColor.red)
+                    .c(RAction.suggest_command, f'!!mpa set {idx} link ')
+                    .h(str(tr('hover.edit_link' if link_ok else 'hover.link_missing'))),
+                RText(' [©]', color=RColor.aqua)
+                    .c(RAction.suggest_command, f'!!mpa copy {idx}')
+                    .h(str(tr('hover.copy_song'))),
+                RText(' [-]', color=RColor.red)
+                    .c(RAction.suggest_command, f'!!mpa del {idx}')
+                    .h(str(tr('hover.delete_song'))),
+            )
+            lines.append(line)
+        if total_pages > 1:
+            lines.append(_page_nav(page, total_pages, '!!mpa info'))
+        return lines
+
+    # link colours depend on the datapack scan, so it is part of the key
+    index = helpers.function_index
+    kind = ('!!mpa info', index.version if index is not None else None)
+    for line in _cached_page(kind, page, render):
         source.reply(line)
-    if total_pages > 1:
-        source.reply(_page_nav(page, total_pages, '!!mpa info'))
+
+
+def cmd_admin_check(source: CommandSource):
+    """!!mpa check — rescan the datapacks and list songs whose function is missing."""
+    index = helpers.function_index
+    if index is None:
+        source.reply(_err_text(str(tr('msg.check_disabled'))))
+        return
+    if not index.scan():
+        source.reply(_err_text(str(tr('msg.check_no_folder', index.path))))
+        return
+    missing = [(i, s) for i, s in enumerate(_load_songs()) if not _link_playable(s.link)]
+    source.reply(_info_text(str(tr('msg.check_result', index.packs, len(index.functions), len(missing)))))
+    for i, s in missing:
+        source.reply(RText(f'  {i + 1}. {s.name} - {s.link}', color=RColor.red)
+                     .c(RAction.suggest_command, f'!!mpa set {i + 1} link ').h(str(tr('hover.edit_link'))))
 
 
 def cmd_admin_set_duration(source: CommandSource, context):
@@ -662,8 +878,7 @@ def cmd_admin_set_duration(source: CommandSource, context):
     if 0 <= idx < len(songs):
         try:
             val = int(context['duration_value'])
-            songs[idx]['duration'] = val
-            _save_songs(songs)
+            helpers.catalog.update(idx, by=_editor(source), duration=val)
             source.reply(_info_text(str(tr('msg.duration_edited', _fmt_duration(val)))))
         except (ValueError, TypeError):
             source.reply(_err_text(str(tr('msg.duration_invalid'))))
@@ -680,55 +895,79 @@ def cmd_admin_debug(source: CommandSource, context=None):
         else:
             source.reply(_err_text(str(tr('msg.debug_usage'))))
             return
+    target = _target(target)
 
     source.reply(_info_text(str(tr('msg.debug_header', target))))
 
     # current song
     current = player_current_song.get(target, None)
     none_text = str(tr('msg.debug_none'))
-    source.reply(RText(str(tr('msg.debug_current_song', current or none_text)), color=RColor.white))
+    current_text = f'#{current} {_link_of(current) or "?"}' if current is not None else none_text
+    source.reply(RText(str(tr('msg.debug_current_song', current_text)), color=RColor.white))
 
     # play mode
     mode = player_play_mode.get(target, 'sequential')
     source.reply(RText(str(tr('msg.debug_play_mode', _tr_mode(mode))), color=RColor.white))
 
     # auto-next timer
-    timer = player_auto_next_timer.get(target, None)
+    timer = helpers.scheduler.get(target)
     if timer:
         alive = timer.is_alive()
         source.reply(RText(str(tr('msg.debug_timer_active', alive, timer.interval)), color=RColor.white))
     else:
         source.reply(RText(str(tr('msg.debug_timer_none')), color=RColor.gray))
+    clock = player_clock.get(target)
+    if clock:
+        source.reply(RText(str(tr('msg.debug_clock', _fmt_clock(clock.position()), _fmt_clock(clock.duration),
+                                  _fmt_clock(clock.remaining()), clock.paused)), color=RColor.white))
+    monitor = helpers.tick_monitor
+    if monitor is not None:
+        drift = clock.drift() if clock else 0.0
+        source.reply(RText(str(tr('msg.debug_tick', f'{monitor.tps:.1f}', len(monitor.samples), f'{drift:.1f}')), color=RColor.white))
+
+    # library cache
+    cat = helpers.catalog
+    source.reply(RText(str(tr('msg.debug_catalog', cat.hits, cat.misses, cat.version)), color=RColor.white))
+    if helpers.page_cache is not None:
+        source.reply(RText(str(tr('msg.debug_pages', *helpers.page_cache.stats())), color=RColor.white))
+    source.reply(RText(str(tr('msg.debug_storage', cat.backend.name)), color=RColor.white))
+    journal = getattr(cat.backend, 'journal', None)
+    if journal is not None:
+        source.reply(RText(str(tr('msg.debug_journal', journal.records, journal.size, cat.backend.compactions)), color=RColor.white))
+    source.reply(RText(str(tr('msg.debug_queues', *helpers.queues.stats())), color=RColor.white))
+    source.reply(RText(str(tr('msg.debug_dispatch', *helpers.dispatcher.stats())), color=RColor.white))
+    session = helpers.sessions.by_key(target)
+    if session is not None:
+        source.reply(RText(str(tr('msg.debug_session', session.number, ', '.join(sorted(session.members)))), color=RColor.white))
 
     # queue
     queue = _load_queue(target)
+    source.reply(RText(str(tr('msg.debug_shuffle', queue.bag_size, len(queue.history))), color=RColor.white))
     source.reply(RText(str(tr('msg.debug_queue', len(queue))), color=RColor.white))
-    songs = _load_songs()
-    for i, link in enumerate(queue):
-        song = next((s for s in songs if s['link'] == link), None)
-        name = song['name'] if song else '?'
-        marker = ' §e◄' if link == current else ''
-        source.reply(RText(f'  {i+1}. {name} ({link}){marker}', color=RColor.gray))
+    for i, song_id in enumerate(queue):
+        _, song = _song_by_id(song_id)
+        name = song.name if song else '?'
+        marker = ' §e◄' if song_id == current else ''
+        source.reply(RText(f'  {i+1}. {name} (#{song_id}){marker}', color=RColor.gray))
 
 
 def _get_timer(source, target):
-    timer = player_auto_next_timer.get(target, None)
+    timer = helpers.scheduler.get(target)
     if not timer:
         source.reply(_err_text(str(tr('msg.timer_not_found', target))))
     return timer
 
 
 def cmd_admin_timer_reset(source: CommandSource, context):
-    target = context['target_player']
+    target = _target(context['target_player'])
     timer = _get_timer(source, target)
     if timer:
-        timer.cancel()
-        player_auto_next_timer.pop(target, None)
+        helpers.scheduler.cancel(target)
         source.reply(_info_text(str(tr('msg.timer_reset', target))))
 
 
 def cmd_admin_timer_interval(source: CommandSource, context):
-    target = context['target_player']
+    target = _target(context['target_player'])
     timer = _get_timer(source, target)
     if not timer:
         return
@@ -737,16 +976,12 @@ def cmd_admin_timer_interval(source: CommandSource, context):
     except (ValueError, TypeError):
         source.reply(_err_text(str(tr('msg.timer_interval_invalid'))))
         return
-    timer.cancel()
-    t = threading.Timer(val, timer.function, args=timer.args or (), kwargs=timer.kwargs or {})
-    t.daemon = True
-    t.start()
-    player_auto_next_timer[target] = t
+    helpers.scheduler.reschedule(target, val)
     source.reply(_info_text(str(tr('msg.timer_interval_set', target, val))))
 
 
 def cmd_admin_timer_active(source: CommandSource, context):
-    target = context['target_player']
+    target = _target(context['target_player'])
     timer = _get_timer(source, target)
     if not timer:
         return
@@ -755,16 +990,13 @@ def cmd_admin_timer_active(source: CommandSource, context):
         if timer.is_alive():
             source.reply(_info_text(str(tr('msg.timer_already_active', target))))
             return
-        t = threading.Timer(timer.interval, timer.function, args=timer.args or (), kwargs=timer.kwargs or {})
-        t.daemon = True
-        t.start()
-        player_auto_next_timer[target] = t
+        helpers.scheduler.reschedule(target)
         source.reply(_info_text(str(tr('msg.timer_reactivated', target, timer.interval))))
     elif flag in ('false', '0', 'off'):
         if not timer.is_alive():
             source.reply(_info_text(str(tr('msg.timer_already_inactive', target))))
             return
-        timer.cancel()
+        helpers.scheduler.suspend(target)
         source.reply(_info_text(str(tr('msg.timer_deactivated', target, timer.interval))))
     else:
         source.reply(_err_text(str(tr('msg.timer_value_invalid'))))
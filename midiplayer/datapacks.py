@@ -0,0 +1,90 @@
+"""Which song functions the world's datapacks actually provide."""
+import os
+import zipfile
+
+_FUNCTION_DIRS = ('function', 'functions')  # 1.21+ / older pack formats
+_SUFFIX = '.mcfunction'
+
+
+def _function_id(path):
+    """``data/<ns>/function(s)/<path>.mcfunction`` -> ``<ns>:<path>``, else None."""
+    if not path.endswith(_SUFFIX):
+        return None
+    parts = path.replace('\\', '/').split('/')
+    # zips sometimes wrap the pack in a top-level folder, so look for data/ anywhere
+    for i in range(len(parts) - 3):
+        if parts[i] == 'data' and parts[i + 2] in _FUNCTION_DIRS:
+            return parts[i + 1] + ':' + '/'.join(parts[i + 3:])[:-len(_SUFFIX)]
+    return None
+
+
+def world_datapacks_dir(working_directory):
+    """``<server dir>/<level-name>/datapacks``, reading level-name from server.properties."""
+    level = 'world'
+    try:
+        with open(os.path.join(working_directory, 'server.properties'), encoding='utf-8') as f:
+            for line in f:
+                key, sep, value = line.partition('=')
+                if sep and key.strip() == 'level-name' and value.strip():
+                    level = value.strip()
+    except OSError:
+        pass
+    return os.path.join(working_directory, level, 'datapacks')
+
+
+class FunctionIndex:
+    """Set of function ids found in a datapacks folder (directories and zips).
+
+    Until a scan has succeeded nothing is known, and :meth:`has` answers
+    True for everything so songs are never skipped because of a missing
+    or unreadable folder. Rescan after the server's ``/reload``.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.functions = None  # set of 'ns:path' once scanned
+        self.packs = 0
+        self.scans = 0
+        self.version = 0
+
+    @property
+    def known(self):
+        return self.functions is not None
+
+    def has(self, function_id):
+        return self.functions is None or function_id in self.functions
+
+    def scan(self):
+        """Re-read the folder; returns False (and forgets everything) if it can't be listed."""
+        try:
+            entries = os.listdir(self.path)
+        except OSError:
+            self.functions = None
+            self.packs = 0
+            self.version += 1
+            return False
+        functions = set()
+        packs = 0
+        for entry in entries:
+            full = os.path.join(self.path, entry)
+            if os.path.isdir(full):
+                packs += 1
+                for root, _, files in os.walk(full):
+                    rel = os.path.relpath(root, full)
+                    for name in files:
+                        fid = _function_id(os.path.join(rel, name))
+                        if fid:
+                            functions.add(fid)
+            elif entry.endswith('.zip'):
+                try:
+                    with zipfile.ZipFile(full) as zf:
+                        names = zf.namelist()
+                except (OSError, zipfile.BadZipFile):
+                    continue
+                packs += 1
+                functions.update(fid for fid in map(_function_id, names) if fid)
+        self.functions = functions
+        self.packs = packs
+        self.scans += 1
+        self.version += 1
+        return True
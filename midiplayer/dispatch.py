@@ -0,0 +1,103 @@
+"""Batched sending of song function calls to the server."""
+import threading
+from collections import OrderedDict
+
+from midiplayer.helpers import _func_cmd
+
+TICK = 0.05  # seconds per game tick at 20 TPS
+
+
+class CommandDispatcher:
+    """Queues ``execute as <selector> run function <link>/<action>`` calls
+    and sends at most ``per_tick`` of them each tick.
+
+    Calls are grouped by selector. A selector's group always goes out
+    whole within one tick, so the stop of the old song and the play of the
+    new one reach the server back to back. Before sending, calls that
+    would have no effect are dropped: a repeat of the call just before it,
+    and a play superseded by a later play for the same selector, together
+    with the stop or pause queued for that never-started song. Flushing
+    runs as a task on the plugin's :class:`~midiplayer.scheduler.Scheduler`.
+    """
+
+    KEY = ('dispatch',)  # scheduler key
+
+    def __init__(self, execute, scheduler, per_tick=20, tick=TICK):
+        self._execute = execute
+        self.scheduler = scheduler
+        self.per_tick = max(1, per_tick)
+        self.tick = tick
+        self._pending = OrderedDict()  # {selector: [(link, action)]}
+        self._lock = threading.Lock()
+        self.submitted = 0
+        self.sent = 0
+        self.dropped = 0
+        self.ticks = 0
+        self.last_tick = 0
+        self.peak_depth = 0
+
+    @property
+    def depth(self):
+        return sum(len(batch) for batch in self._pending.values())
+
+    def function(self, selector, link, action):
+        """Queue ``link``'s ``action`` function (play/stop/pause) for ``selector``."""
+        with self._lock:
+            self.submitted += 1
+            batch = self._pending.setdefault(selector, [])
+            if batch and batch[-1] == (link, action):
+                self.dropped += 1
+                return
+            if action == 'play':
+                self._drop_superseded(batch)
+            batch.append((link, action))
+            self.peak_depth = max(self.peak_depth, self.depth)
+        if self.scheduler.get(self.KEY) is None:
+            self.scheduler.schedule(self.KEY, self.tick, self._run_tick)
+
+    def _drop_superseded(self, batch):
+        """Remove the last queued play and everything queued for its song after it."""
+        for i in range(len(batch) - 1, -1, -1):
+            link, action = batch[i]
+            if action != 'play':
+                continue
+            kept = batch[:i] + [call for call in batch[i + 1:] if call[0] != link]
+            self.dropped += len(batch) - len(kept)
+            batch[:] = kept
+            return
+
+    def _take(self, budget):
+        """Pop whole selector groups that fit in ``budget`` (at least one)."""
+        lines = []
+        while self._pending:
+            selector, batch = next(iter(self._pending.items()))
+            if lines and len(batch) > budget - len(lines):
+                break
+            del self._pending[selector]
+            lines.extend(f'execute as {selector} run function {_func_cmd(link, action)}' for link, action in batch)
+        return lines
+
+    def _run_tick(self):
+        with self._lock:
+            lines = self._take(self.per_tick)
+            self.ticks += 1
+            self.last_tick = len(lines)
+            self.sent += len(lines)
+            more = bool(self._pending)
+        for line in lines:
+            self._execute(line)
+        if more:
+            self.scheduler.schedule(self.KEY, self.tick, self._run_tick)
+
+    def flush(self):
+        """Send everything queued now, ignoring the per-tick cap (unload)."""
+        with self._lock:
+            lines = self._take(float('inf'))
+            self.sent += len(lines)
+        self.scheduler.cancel(self.KEY)
+        for line in lines:
+            self._execute(line)
+
+    def stats(self):
+        return self.depth, self.peak_depth, self.sent, self.ticks, self.last_tick, self.per_tick, self.dropped
+
@@ -1,25 +1,55 @@
-import json
-import os
+import threading
+import time
 
 from mcdreforged.api.all import *
 
+from midiplayer.search import SearchEngine, SuggestionTrie
+from midiplayer.sessions import SessionRegistry, RADIO_KEY
+from midiplayer.song import _assign_ids, _ids_by_link
+
 # ── globals (set by midiplayer.on_load) ──
 data_folder = ''
 songs_json_file = ''
-queues_dir = ''
+queues_dir = ''               # pre-queues.db layout, imported once
+queues_db_file = ''
+backend = None               # JsonBackend | SqliteBackend
+queues = None                # QueueManager
 player_pages = {}
 player_pages_queue = {}
-player_current_song = {}
+player_current_song = {}     # {player: song id}
 player_play_mode = {}        # {player: 'single'|'random'|'sequential'|'loop'}
 player_paused = {}           # {player: bool}
-player_auto_next_timer = {}  # {player: threading.Timer}
+player_clock = {}            # {player: PlaybackClock}
+scheduler = None             # Scheduler; auto-next tasks are keyed by player
+dispatcher = None            # CommandDispatcher
+function_index = None        # FunctionIndex of the world's datapacks, when check_links is on
+page_cache = None            # PageCache of rendered list/links/info pages
+tick_monitor = None          # TickRateMonitor when tick_compensation is on
+sessions = SessionRegistry()
 items_per_page = 8
+suggestion_limit = 20
+radio_mode = 'random'        # 'random' | 'loop'
+radio_tag = ''               # only songs tagged with this are on the radio; '' for all
 PLAY_MODES = ('single', 'random', 'sequential', 'loop')
 
 
 class Config(Serializable):
     edit_permission: int = 2
     items_per_page: int = 8
+    suggestion_limit: int = 20
+    storage_backend: str = 'json'  # 'json' | 'sqlite'
+    save_delay: float = 2.0
+    journal_compact_bytes: int = 65536
+    pretty_songs_json: bool = False
+    queue_cache_size: int = 1000
+    tick_compensation: bool = False
+    tick_sample_interval: float = 5.0
+    radio_mode: str = 'random'  # 'random' | 'loop'
+    radio_tag: str = ''
+    commands_per_tick: int = 20
+    check_links: bool = True
+    datapacks_dir: str = ''  # default: <server dir>/<level-name>/datapacks
+    page_cache_size: int = 256
 
 
 def tr(key, *args):
@@ -37,44 +67,392 @@ def _func_cmd(link, action):
     return f'{link}:{action}'
 
 
+def _song_function(selector, link, action):
+    """Have ``selector`` run the song's play/stop/pause function, batched per tick."""
+    dispatcher.function(selector, link, action)
+
+
 # ── data helpers ──
 
-def _ensure_songs_file():
-    if not os.path.exists(songs_json_file):
-        with open(songs_json_file, 'w', encoding='utf-8') as f:
-            json.dump([], f, indent=4)
+class LibrarySnapshot:
+    """One version of the song library, never changed after it is published.
+
+    Readers take the current snapshot once and use it for the whole
+    operation, so a concurrent admin edit can't shift positions under
+    them; nothing holds on to a snapshot after that, so an old one is
+    freed as soon as the last command using it returns.
+    """
+
+    __slots__ = ('version', 'songs', '_by_id', '_link_ids')
+
+    def __init__(self, version, songs):
+        self.version = version
+        self.songs = tuple(songs)
+        self._by_id = {s.id: i for i, s in enumerate(self.songs)}  # {song id: index}
+        self._link_ids = None  # {link: song id}, built on first use
+
+    def __len__(self):
+        return len(self.songs)
+
+    def locate(self, song_id):
+        """Return (position, song) for ``song_id``, or (None, None)."""
+        idx = self._by_id.get(song_id)
+        if idx is None:
+            return None, None
+        return idx, self.songs[idx]
+
+    def id_for_link(self, link):
+        if self._link_ids is None:
+            by_link = {}
+            for song in self.songs:
+                by_link.setdefault(song.link, song.id)
+            self._link_ids = by_link
+        return self._link_ids.get(link)
+
+
+class SongCatalog:
+    """The song library, published as a series of :class:`LibrarySnapshot`.
+
+    The library is only loaded from the storage backend again when the
+    backend's stamp changes (songs.json replaced on disk, or another
+    connection writing to the database). Admin edits build the next
+    snapshot from the current one and are handed to the backend as small
+    edit records; for the JSON backend those go to a journal that is
+    folded back into songs.json in the background once it grows too large.
+    Songs are replaced, not modified, so a published snapshot stays valid.
+    The search index and completion trie are patched with each edit and
+    carried over to the new snapshot instead of being rebuilt.
+
+    Every song has a stable integer id that is never reused; queues and
+    the current song refer to songs by id. Songs loaded without one (a
+    songs.json written by the CLI/GUI tool) get fresh ids, or the id of a
+    previously loaded song with the same link.
+    """
+
+    def __init__(self, backend=None, compact_delay=2.0):
+        self.backend = backend
+        self.compact_delay = compact_delay
+        self.hits = 0
+        self.misses = 0
+        self._snapshot = None  # current LibrarySnapshot
+        self._last_version = 0
+        self._stamp = None
+        self.next_id = 1
+        self._engine = None
+        self._engine_version = None
+        self._trie = None
+        self._trie_version = None
+        self._lock = threading.RLock()
+        self._compact_timer = None
+
+    @property
+    def version(self):
+        return self._last_version
+
+    def _stale(self):
+        return self._snapshot is None or self.backend.stamp() != self._stamp
+
+    def _publish(self, songs):
+        self._last_version += 1
+        self._snapshot = LibrarySnapshot(self._last_version, songs)
+        return self._snapshot
+
+    def snapshot(self):
+        """The current snapshot, reloading it if the backend changed."""
+        with self._lock:
+            if not self._stale():
+                self.hits += 1
+                return self._snapshot
+            self.misses += 1
+            previous = self._snapshot.songs if self._snapshot is not None else None
+            songs = self.backend.load()
+            if self._assign_ids(songs, previous):
+                self.backend.replace(songs)
+            self._stamp = self.backend.stamp()
+            return self._publish(songs)
+
+    def current_version(self):
+        """Identifies the library as stored now: the snapshot version, or the
+        backend's stamp while a paged backend is read without a snapshot."""
+        with self._lock:
+            if self.backend.paged and self._stale():
+                return 'stamp', self.backend.stamp()
+            return self.snapshot().version
+
+    def songs(self):
+        """The songs of the current snapshot (a tuple)."""
+        return self.snapshot().songs
+
+    def count(self):
+        """Number of songs, without loading the whole library if the backend can page."""
+        with self._lock:
+            if self.backend.paged and self._stale():
+                return self.backend.count()
+            return len(self.songs())
+
+    def page(self, start, end):
+        """Songs ``start:end``, queried from the backend when it supports paging."""
+        with self._lock:
+            if self.backend.paged and self._stale():
+                return self.backend.page(start, end)
+            return self.songs()[start:end]
+
+    def compact(self):
+        """Let the backend fold journaled edits into its snapshot."""
+        with self._lock:
+            if self._compact_timer is not None:
+                self._compact_timer.cancel()
+                self._compact_timer = None
+            if self._snapshot is None:
+                return
+            self.backend.compact(self._snapshot.songs)
+            self._stamp = self.backend.stamp()
+
+    def flush(self):
+        """Persist everything synchronously (called on unload)."""
+        with self._lock:
+            if self._compact_timer is not None:
+                self._compact_timer.cancel()
+                self._compact_timer = None
+            self.backend.flush(self._snapshot.songs if self._snapshot is not None else None)
+            self._stamp = self.backend.stamp()
+
+    def _record(self, record, by):
+        """Persist an edit that was just published."""
+        record['by'] = by
+        record['ts'] = int(time.time())
+        compact_due = self.backend.record(record)
+        if compact_due and self._compact_timer is None:
+            self._compact_timer = threading.Timer(self.compact_delay, self.compact)
+            self._compact_timer.daemon = True
+            self._compact_timer.start()
+
+    # ── ids ──
+
+    def _assign_ids(self, songs, previous=None):
+        """Give songs without a (unique) id one; returns True if any changed.
+
+        Ids are matched by link against the previous snapshot, or after a
+        restart against the ids the backend remembers.
+        """
+        if previous is not None:
+            known = _ids_by_link((s.link, s.id) for s in previous)
+        else:
+            known = self.backend.known_ids()
+        changed, self.next_id = _assign_ids(songs, max(self.next_id, self.backend.next_id()), known)
+        return changed
+
+    def _new_id(self):
+        song_id = self.next_id
+        self.next_id += 1
+        return song_id
+
+    def locate(self, song_id):
+        """Return (position, song) for ``song_id`` in the current snapshot, or (None, None)."""
+        snapshot = self._snapshot
+        if snapshot is None:
+            snapshot = self.snapshot()
+        return snapshot.locate(song_id)
+
+    def id_for_link(self, link):
+        """Id of the first song with ``link``, or None (queues saved before ids existed)."""
+        return self.snapshot().id_for_link(link)
+
+    def search_engine(self):
+        """Return the search index for the current library, rebuilding it if stale."""
+        with self._lock:
+            snapshot = self.snapshot()
+            if self._engine is None or self._engine_version != snapshot.version:
+                self._engine = SearchEngine(snapshot.songs)
+                self._engine_version = snapshot.version
+            return self._engine
+
+    def suggestion_trie(self):
+        """Return the completion trie for the current library, rebuilding it if stale."""
+        with self._lock:
+            snapshot = self.snapshot()
+            if self._trie is None or self._trie_version != snapshot.version:
+                self._trie = SuggestionTrie(snapshot.songs, limit=suggestion_limit)
+                self._trie_version = snapshot.version
+            return self._trie
+
+    def _carry_indexes(self, previous, snapshot, patch_engine, patch_trie=None):
+        """Patch the search index and trie of version ``previous`` to serve ``snapshot``.
+
+        Whatever was not built for ``previous`` (or has no ``patch_trie``)
+        is left stale and rebuilt on next use.
+        """
+        if self._engine is not None and self._engine_version == previous:
+            patch_engine(self._engine)
+            self._engine_version = snapshot.version
+        if patch_trie is not None and self._trie is not None and self._trie_version == previous:
+            patch_trie(self._trie)
+            self._trie_version = snapshot.version
+
+    # ── mutations (journaled) ──
+
+    def append(self, song, by=None):
+        with self._lock:
+            snapshot = self.snapshot()
+            if song.id is None or snapshot.locate(song.id)[1] is not None:
+                song.id = self._new_id()
+            else:
+                self.next_id = max(self.next_id, song.id + 1)
+            new = self._publish(snapshot.songs + (song,))
+            self._carry_indexes(snapshot.version, new, lambda e: e.add(new.songs), lambda t: t.add(song))
+            self._record({'op': 'add', 'song': song.to_dict()}, by)
+
+    def pop(self, idx, by=None):
+        with self._lock:
+            snapshot = self.snapshot()
+            songs = list(snapshot.songs)
+            song = songs.pop(idx)
+            new = self._publish(songs)
+            self._carry_indexes(snapshot.version, new, lambda e: e.remove(idx, new.songs))
+            self._record({'op': 'del', 'index': idx, 'id': song.id}, by)
+            return song
+
+    def update(self, idx, by=None, **fields):
+        with self._lock:
+            snapshot = self.snapshot()
+            songs = list(snapshot.songs)
+            song = songs[idx] = songs[idx].copy(keep_id=True)
+            song.update(**fields)
+            new = self._publish(songs)
+            # completions only come from name and link
+            keep_trie = None if {'name', 'link'} & fields.keys() else (lambda t: None)
+            self._carry_indexes(snapshot.version, new, lambda e: e.replace(idx, new.songs), keep_trie)
+            self._record({'op': 'set', 'index': idx, 'fields': fields}, by)
+            return song
+
+
+catalog = SongCatalog()
 
 
 def _load_songs():
-    _ensure_songs_file()
-    with open(songs_json_file, 'r', encoding='utf-8') as f:
-        return json.load(f)
+    return catalog.songs()
 
 
-def _save_songs(data):
-    with open(songs_json_file, 'w', encoding='utf-8') as f:
-        json.dump(data, f, ensure_ascii=False, indent=4)
+def _editor(source):
+    """Name recorded in the library journal for an edit made by ``source``."""
+    return source.player if source.is_player else 'console'
 
 
-def _queue_path(player):
-    return os.path.join(queues_dir, f'{player}.json')
+def _song_by_id(song_id):
+    """Return (index, song) for a song id, or (None, None)."""
+    if song_id is None:
+        return None, None
+    return catalog.locate(song_id)
+
+
+def _link_of(song_id):
+    """Link of the song with ``song_id``, or None if it was deleted."""
+    _, song = _song_by_id(song_id)
+    return song.link if song else None
+
+
+def _link_playable(link):
+    """Whether the song's play function exists; True when the datapacks are unknown."""
+    return function_index is None or function_index.has(_func_cmd(link, 'play'))
+
+
+def _playable_song(song_id):
+    """The song with ``song_id`` if it is in the library and its datapack is loaded."""
+    _, song = _song_by_id(song_id)
+    return song if song and _link_playable(song.link) else None
 
 
 def _load_queue(player):
-    path = _queue_path(player)
-    if os.path.exists(path):
-        with open(path, 'r', encoding='utf-8') as f:
-            return json.load(f)
-    return []
+    if player == RADIO_KEY:
+        return _radio_queue()
+    return queues.get(player)
 
 
 def _save_queue(player, queue):
-    with open(_queue_path(player), 'w', encoding='utf-8') as f:
-        json.dump(queue, f, ensure_ascii=False, indent=4)
+    queues.save(player, queue)
 
 
 def _has_queue(player):
-    return os.path.exists(_queue_path(player))
+    return queues.has(player)
+
+
+_radio_version = None  # catalog version the radio rotation was last synced to
+
+
+def _radio_queue():
+    """The radio rotation: every song with a duration (and radio_tag, if set).
+
+    Kept as an ordinary queue and only compared against the library again
+    after the library changed.
+    """
+    global _radio_version
+    queue = queues.get(RADIO_KEY)
+    songs = catalog.songs()
+    if _radio_version == catalog.version:
+        return queue
+    wanted = {s.id for s in songs if s.duration and (not radio_tag or radio_tag in _song_tags(s))}
+    if not wanted and radio_tag and any(s.duration for s in songs):
+        ServerInterface.psi().logger.warning(f'No song with a duration is tagged {radio_tag!r} (radio_tag); the radio has nothing to play')
+    changed = False
+    for song_id in list(queue):
+        if song_id not in wanted:
+            changed |= queue.remove(song_id)
+    for song in songs:
+        if song.id in wanted:
+            changed |= queue.append(song.id)
+    if changed:
+        queues.save(RADIO_KEY, queue)
+    _radio_version = catalog.version
+    return queue
+
+
+def _song_tags(song):
+    """The optional ``tags`` of a song in songs.json, as a list or comma-separated string."""
+    tags = (song.extra or {}).get('tags', ())
+    if isinstance(tags, str):
+        tags = tags.split(',')
+    return [str(t).strip() for t in tags]
+
+
+def _store_player_state(player):
+    """Save a leaving player's play mode and current song."""
+    backend.queues.save_player_state(player, player_play_mode.get(player), player_current_song.get(player))
+
+
+def _restore_player_state(player):
+    """Bring back what _store_player_state saved; playback starts paused."""
+    if player in player_current_song or player in player_play_mode:
+        return
+    state = backend.queues.load_player_state(player)
+    if state is None:
+        return
+    mode, current = state
+    if mode in PLAY_MODES:
+        player_play_mode[player] = mode
+    if current is not None and catalog.locate(current)[1] is not None:
+        player_current_song[player] = current
+        player_paused[player] = True
+
+
+def _target(player):
+    """Key a player's playback state lives under: their session's, or their own name."""
+    return sessions.target(player)
+
+
+def _selector(target):
+    """Who ``execute as`` should run a song function for, given a playback key."""
+    return sessions.selector(target)
+
+
+def _playback_speed():
+    """Song seconds per wall second: below 1.0 while the server lags."""
+    return tick_monitor.speed if tick_monitor is not None else 1.0
+
+
+def _forget_player(player):
+    """Drop a player's in-memory state (pages, mode, current song, clock)."""
+    for state in (player_pages, player_pages_queue, player_current_song, player_play_mode, player_paused, player_clock):
+        state.pop(player, None)
 
 
 def _fmt_duration(seconds):
@@ -84,6 +462,13 @@ def _fmt_duration(seconds):
     return f'{m}:{s:02d}'
 
 
+def _fmt_clock(seconds):
+    """Like _fmt_duration, but 0 is '0:00' and None is '?'."""
+    if seconds is None:
+        return '?'
+    return _fmt_duration(seconds) or '0:00'
+
+
 # ── RText helpers ──
 
 def _info_text(msg):
@@ -101,19 +486,19 @@ def _song_text(idx, song, *, clickable=True, show_duration=True, highlight=False
 
     Args:
         idx: 1-based display index
-        song: song dict with 'name', 'artist', 'link', optional 'duration'
-        clickable: if True, song name is clickable (suggest !!mp play <idx>)
+        song: Song
+        clickable: if True, song name is clickable (suggest !!mp play #<id>)
         show_duration: if True, append [m:ss] duration
         highlight: if True, use aqua color + ◄ marker (current playing)
         action: 'add' for [+] button, 'remove' for [-] button, None for no button
     """
-    artists = ', '.join(song['artist'])
-    dur = _fmt_duration(song.get('duration')) if show_duration else ''
+    artists = ', '.join(song.artist)
+    dur = _fmt_duration(song.duration) if show_duration else ''
     dur_str = f' [{dur}]' if dur else ''
     name_color = RColor.aqua if highlight else RColor.green
-    name_text = RText(song['name'], color=name_color)
+    name_text = RText(song.name, color=name_color)
     if clickable:
-        name_text.c(RAction.suggest_command, f'!!mp play {idx}').h(str(tr('hover.play', song['name'])))
+        name_text.c(RAction.suggest_command, f'!!mp play #{song.id}').h(str(tr('hover.play', song.name)))
     marker = ' §e◄' if highlight else ''
     parts = [
         RText(f'{idx}. ', color=RColor.gray),
@@ -121,9 +506,9 @@ def _song_text(idx, song, *, clickable=True, show_duration=True, highlight=False
         RText(f' - {artists}{dur_str}{marker}'),
     ]
     if action == 'add':
-        parts.append(RText(' [+]', color=RColor.green).c(RAction.suggest_command, f'!!mp add {idx}').h(str(tr('hover.add_queue'))))
+        parts.append(RText(' [+]', color=RColor.green).c(RAction.suggest_command, f'!!mp add #{song.id}').h(str(tr('hover.add_queue'))))
     elif action == 'remove':
-        parts.append(RText(' [-]', color=RColor.red).c(RAction.suggest_command, f'!!mp remove {idx}').h(str(tr('hover.remove_queue'))))
+        parts.append(RText(' [-]', color=RColor.red).c(RAction.suggest_command, f'!!mp remove #{song.id}').h(str(tr('hover.remove_queue'))))
     return RTextList(*parts)
 
 
@@ -142,8 +527,7 @@ def _page_nav(page, total_pages, cmd_base):
 
 # ── pagination helpers ──
 
-def _get_page(data, player, pages_dict):
-    total = len(data)
+def _get_page(total, player, pages_dict):
     total_pages = max(1, (total + items_per_page - 1) // items_per_page)
     page = pages_dict.get(player, 1)
     page = min(page, total_pages)
@@ -152,53 +536,82 @@ def _get_page(data, player, pages_dict):
     return page, start, end, total_pages
 
 
-def _show_song_page(source, songs, page, start, end, total_pages, cmd_base='!!mp list'):
-    """Display a page of songs with clickable entries and pagination."""
-    source.reply(_info_text(str(tr('msg.page_info', page, total_pages))))
-    for idx in range(start, end):
-        source.reply(_song_text(idx + 1, songs[idx], action='add'))
-    source.reply(_page_nav(page, total_pages, cmd_base))
+def _cached_page(kind, page, render):
+    """Lines of a library page from the page cache, rendered on a miss.
 
+    Pages are the same for every player with the same language, so they
+    are keyed by what they show, not by who asked; a new library version
+    empties the cache.
+    """
+    version = catalog.current_version()
+    if page_cache is None:
+        return render()
+    key = (kind, page, items_per_page, ServerInterface.psi().get_mcdr_language())
+    return page_cache.get(version, key, render)
 
-def _show_queue_page(source, queue, songs, page, start, end, total_pages, current_link=None):
+
+def _show_song_page(source, page, start, end, total_pages, cmd_base='!!mp list'):
+    """Display songs ``start:end`` of the library with clickable entries and pagination."""
+    def render():
+        lines = [_info_text(str(tr('msg.page_info', page, total_pages)))]
+        for offset, song in enumerate(catalog.page(start, end)):
+            lines.append(_song_text(start + offset + 1, song, action='add'))
+        lines.append(_page_nav(page, total_pages, cmd_base))
+        return lines
+
+    for line in _cached_page(cmd_base, page, render):
+        source.reply(line)
+
+
+def _show_queue_page(source, queue, songs, page, start, end, total_pages, current_id=None):
     """Display a page of queue with clickable entries and pagination."""
     source.reply(_info_text(str(tr('msg.page_info', page, total_pages))))
     for idx in range(start, end):
-        link = queue[idx]
-        song = next((s for s in songs if s['link'] == link), None)
+        song_id = queue[idx]
+        global_idx, song = _song_by_id(song_id)
         if song:
-            is_current = link == current_link
-            # find global song index for remove command
-            global_idx = next((i for i, s in enumerate(songs) if s['link'] == link), idx)
+            is_current = song_id == current_id
             source.reply(_song_text(global_idx + 1, song, highlight=is_current, action='remove'))
     source.reply(_page_nav(page, total_pages, '!!mp queue'))
 
 
-def _show_search_results(source, matches):
+def _show_search_results(source, matches, did_you_mean=False):
     """Display search results with clickable song names."""
-    source.reply(_info_text(str(tr('msg.found_songs', len(matches)))))
+    header = tr('msg.did_you_mean') if did_you_mean else tr('msg.found_songs', len(matches))
+    source.reply(_info_text(str(header)))
     for idx, song in matches:
         source.reply(_song_text(idx + 1, song, show_duration=False, action='add'))
 
 
+def _show_no_match(source, keyword):
+    """Reply with fuzzy "did you mean" suggestions, or msg.no_match if there are none."""
+    matches = catalog.search_engine().fuzzy(keyword)
+    if matches:
+        _show_search_results(source, matches, did_you_mean=True)
+    else:
+        source.reply(_err_text(str(tr('msg.no_match'))))
+
+
 # ── song matching ──
 
 def _find_song(songs, user_input, raw=None):
     """Returns (song, index) or list of (index, song) matches, or None.
-    raw is the original input before underscore replacement."""
+    raw is the original input before underscore replacement.
+    Digits are a list position, '#<id>' a song id."""
+    if user_input.startswith('#') and user_input[1:].isdigit():
+        idx, song = _song_by_id(int(user_input[1:]))
+        return (song, idx) if song else None
     if user_input.isdigit():
         idx = int(user_input) - 1
         if 0 <= idx < len(songs):
             return songs[idx], idx
         return None
-    raw = raw or user_input
-    matches = [
-        (i, s) for i, s in enumerate(songs)
-        if user_input.lower() in s['name'].lower()
-        or raw.lower() in s['name'].lower()
-        or raw.lower() in s.get('link', '').lower()
-        or any(user_input.lower() in a.lower() for a in s['artist'])
-    ]
+    engine = catalog.search_engine()
+    exact, prefix, substring = engine.search_tiers(raw or user_input)
+    # a single exact hit wins even if looser matches exist
+    if len(exact) == 1:
+        return engine.songs[exact[0]], exact[0]
+    matches = [(i, engine.songs[i]) for i in exact + prefix + substring]
     if len(matches) == 1:
         return matches[0][1], matches[0][0]
     if matches:
@@ -1,15 +1,21 @@
 import os
-import random
-import threading
 
 from mcdreforged.api.all import *
 from mcdreforged.api.command import SimpleCommandBuilder, Integer, Text
 
 from midiplayer import helpers
+from midiplayer.queues import QueueManager
+from midiplayer.scheduler import Scheduler
+from midiplayer.dispatch import CommandDispatcher
+from midiplayer.pagecache import PageCache
+from midiplayer.datapacks import FunctionIndex, world_datapacks_dir
+from midiplayer.sessions import OBJECTIVE as SESSION_OBJECTIVE, KEY_PREFIX as SESSION_KEY_PREFIX
+from midiplayer.tickrate import TickRateMonitor
+from midiplayer.storage import JsonBackend, SqliteBackend
 from midiplayer.helpers import (
-    Config, tr, _ensure_songs_file, _load_songs, _load_queue,
-    _send_help, _info_text, _func_cmd,
-    player_current_song, player_play_mode, player_auto_next_timer,
+    Config, tr, _load_queue, _playable_song, _link_of, _selector,
+    _send_help, _info_text, _song_function,
+    player_current_song, player_play_mode, player_clock,
     player_pages, player_pages_queue, PLAY_MODES,
 )
 from midiplayer.commands import (
@@ -17,24 +23,23 @@ from midiplayer.commands import (
     cmd_stop, cmd_resume, cmd_now, cmd_mode, cmd_next, cmd_prev,
     cmd_shuffle, cmd_add_to_queue, cmd_remove_from_queue,
     cmd_queue, cmd_queue_search, cmd_clear,
+    cmd_session, cmd_session_create, cmd_session_join, cmd_session_leave, cmd_radio,
     cmd_admin_add, cmd_admin_del, cmd_admin_copy,
     cmd_admin_set_name, cmd_admin_set_artist, cmd_admin_set_link,
-    cmd_admin_set_duration, cmd_admin_info, cmd_admin_debug,
+    cmd_admin_set_duration, cmd_admin_info, cmd_admin_debug, cmd_admin_check,
     cmd_admin_timer_reset, cmd_admin_timer_interval, cmd_admin_timer_active,
-    _play_song_and_timer,
+    _play_song_and_timer, _leave_session,
 )
 
 
 # ── auto-advance timer ──
 
-def _cancel_auto_next(player):
-    t = player_auto_next_timer.pop(player, None)
-    if t:
-        t.cancel()
+def _cancel_auto_next(target):
+    helpers.scheduler.cancel(target)
 
 
-def _start_auto_next(server, player, duration, songs, _msgs=None):
-    _cancel_auto_next(player)
+def _start_auto_next(server, target, duration, _msgs=None):
+    _cancel_auto_next(target)
 
     # pre-fetch translation templates on plugin thread; Timer thread can't call tr()
     # msg.auto_next contains {0} placeholder — pass a unique marker so MCDR's
@@ -46,61 +51,106 @@ def _start_auto_next(server, player, duration, songs, _msgs=None):
     tpl_auto_next, msg_seq_end = _msgs
 
     def _next_song(song, current):
-        if current:
-            server.execute(f'execute as {player} run function {_func_cmd(current, "stop")}')
+        current_link = _link_of(current)
+        if current_link:
+            _song_function(_selector(target), current_link, 'stop')
         try:
-            msg = tpl_auto_next.format(song['name'])
+            msg = tpl_auto_next.format(song.name)
         except (IndexError, KeyError):
             msg = tpl_auto_next
-        server.tell(player, _info_text(msg))
-        _play_song_and_timer(server, player, song, songs, _msgs=_msgs)
+        server.tell(_selector(target), _info_text(msg))
+        _play_song_and_timer(server, target, song, _msgs=_msgs)
 
     def callback():
-        player_auto_next_timer.pop(player, None)
-        queue = _load_queue(player)
+        queue = _load_queue(target)
         if not queue:
             return
-        mode = player_play_mode.get(player, 'sequential')
-        current = player_current_song.get(player)
+        mode = player_play_mode.get(target, 'sequential')
+        current = player_current_song.get(target)
 
+        # songs deleted from the library or missing from the datapacks are stepped over
         if mode == 'single':
-            if current:
-                song = next((s for s in songs if s['link'] == current), None)
-                if song:
-                    _next_song(song, None)
+            song = _playable_song(current)
+            if song:
+                _next_song(song, None)
         elif mode == 'random':
-            candidates = [q for q in queue if q != current]
-            if not candidates:
-                candidates = list(queue)
-            random.shuffle(candidates)
             song = None
-            for link in candidates:
-                song = next((s for s in songs if s['link'] == link), None)
+            for _ in range(len(queue)):
+                song = _playable_song(queue.draw())
                 if song:
                     break
             if song:
                 _next_song(song, current)
         elif mode == 'loop':
-            idx = (queue.index(current) + 1) % len(queue) if current and current in queue else 0
-            song = next((s for s in songs if s['link'] == queue[idx]), None)
-            if song:
-                _next_song(song, current)
+            idx = queue.locate(current)
+            start = -1 if idx is None else idx
+            for step in range(1, len(queue) + 1):
+                song = _playable_song(queue[(start + step) % len(queue)])
+                if song:
+                    _next_song(song, current)
+                    break
         else:  # sequential
-            if current and current in queue:
-                idx = queue.index(current) + 1
-                if idx >= len(queue):
-                    server.tell(player, _info_text(msg_seq_end))
-                    return
-            else:
-                idx = 0
-            song = next((s for s in songs if s['link'] == queue[idx]), None)
-            if song:
-                _next_song(song, current)
+            idx = queue.locate(current)
+            song = None
+            for i in range(0 if idx is None else idx + 1, len(queue)):
+                song = _playable_song(queue[i])
+                if song:
+                    break
+            if song is None:
+                server.tell(_selector(target), _info_text(msg_seq_end))
+                return
+            _next_song(song, current)
+
+    helpers.scheduler.schedule(target, duration, callback)
+
+
+# ── tick-rate compensation ──
+
+_TPS_TASK = ('tick-rate',)  # scheduler key; player keys are plain strings
+
+
+def _sample_tick_rate(server, interval):
+    """Ask the server for its game time; the answer arrives through on_info."""
+    helpers.tick_monitor.sample(server)
+    helpers.scheduler.schedule(_TPS_TASK, interval, lambda: _sample_tick_rate(server, interval))
+
+
+def _apply_tick_rate():
+    """Stretch every song's clock and pending auto-next to the measured tick rate."""
+    speed = helpers.tick_monitor.speed
+    for player, clock in list(player_clock.items()):
+        clock.set_speed(speed)
+        task = helpers.scheduler.get(player)
+        remaining = clock.wall_remaining()
+        if task is not None and task.is_alive() and not clock.paused and remaining is not None:
+            helpers.scheduler.reschedule(player, remaining)
+
 
-    t = threading.Timer(duration + 1, callback)
-    t.daemon = True
-    t.start()
-    player_auto_next_timer[player] = t
+# ── sessions ──
+
+def _setup_session_scoreboard(server):
+    """Create the session objective; scores left over from before a restart are cleared."""
+    server.execute(f'scoreboard objectives add {SESSION_OBJECTIVE} dummy')
+    if not len(helpers.sessions):
+        server.execute(f'scoreboard players reset * {SESSION_OBJECTIVE}')
+
+
+# ── command suggestions ──
+
+def _suggest_keyword(source, context):
+    """Suggestions for the shared <keyword> argument, by sub-command."""
+    words = context.command_read.split()
+    sub = words[1] if len(words) > 1 else ''
+    if sub == 'mode':
+        return PLAY_MODES
+    if sub in ('search', 'play', 'add', 'remove', 'queue'):
+        # the partial argument is already parsed into the context while suggesting
+        return helpers.catalog.suggestion_trie().complete(context.get('keyword', ''))
+    return []
+
+
+def _suggest_session(source, context):
+    return [s.name for s in helpers.sessions]
 
 
 # ── lifecycle ──
@@ -110,12 +160,50 @@ def on_load(server: PluginServerInterface, prev_module):
     helpers.data_folder = server.get_data_folder()
     helpers.songs_json_file = os.path.join(helpers.data_folder, 'songs.json')
     helpers.queues_dir = os.path.join(helpers.data_folder, 'queues')
-    os.makedirs(helpers.queues_dir, exist_ok=True)
-    _ensure_songs_file()
+    helpers.queues_db_file = os.path.join(helpers.data_folder, 'queues.db')
 
     # config
     config = server.load_config_simple(target_class=Config)
     helpers.items_per_page = config.items_per_page
+    helpers.suggestion_limit = config.suggestion_limit
+    helpers.radio_tag = config.radio_tag
+    helpers.radio_mode = config.radio_mode if config.radio_mode in ('random', 'loop') else 'random'
+
+    # storage
+    json_backend = JsonBackend(
+        helpers.songs_json_file, helpers.queues_db_file,
+        compact_bytes=config.journal_compact_bytes, pretty=config.pretty_songs_json, logger=server.logger,
+    )
+    imported = json_backend.queues.import_dir(helpers.queues_dir, server.logger)
+    if imported:
+        server.logger.info(f'Imported {imported} queue files from queues/ into queues.db')
+    if config.storage_backend == 'sqlite':
+        helpers.backend = SqliteBackend(os.path.join(helpers.data_folder, 'midiplayer.db'))
+        if helpers.backend.migrate_from(json_backend):
+            server.logger.info('Migrated songs.json and queues.db into midiplayer.db')
+        json_backend.close()
+    else:
+        if config.storage_backend != 'json':
+            server.logger.warning(f'Unknown storage_backend {config.storage_backend!r}, using json')
+        helpers.backend = json_backend
+    helpers.catalog = helpers.SongCatalog(helpers.backend, compact_delay=config.save_delay)
+    helpers.page_cache = PageCache(config.page_cache_size)
+    helpers.scheduler = Scheduler(logger=server.logger)
+    helpers.dispatcher = CommandDispatcher(server.execute, helpers.scheduler, per_tick=config.commands_per_tick)
+    helpers.tick_monitor = None
+    if config.tick_compensation:
+        helpers.tick_monitor = TickRateMonitor()
+        helpers.scheduler.schedule(_TPS_TASK, config.tick_sample_interval,
+                                   lambda: _sample_tick_rate(server, config.tick_sample_interval))
+    helpers.function_index = None
+    if config.check_links:
+        path = config.datapacks_dir or world_datapacks_dir(server.get_mcdr_config().get('working_directory', 'server'))
+        helpers.function_index = FunctionIndex(path)
+        if not helpers.function_index.scan():
+            server.logger.warning(f'Datapacks folder {path} not found; song links will not be checked')
+    helpers.queues = QueueManager(helpers.backend.queues, flush_delay=config.save_delay,
+                                  resolve_link=helpers.catalog.id_for_link,
+                                  capacity=config.queue_cache_size)
 
     # preserve state across reloads
     if prev_module is not None:
@@ -123,10 +211,25 @@ def on_load(server: PluginServerInterface, prev_module):
         helpers.player_current_song.update(getattr(prev_module, 'player_current_song', getattr(getattr(prev_module, 'helpers', None), 'player_current_song', {})))
         helpers.player_pages_queue.update(getattr(prev_module, 'player_pages_queue', getattr(getattr(prev_module, 'helpers', None), 'player_pages_queue', {})))
         helpers.player_play_mode.update(getattr(prev_module, 'player_play_mode', getattr(getattr(prev_module, 'helpers', None), 'player_play_mode', {})))
-        # cancel old timers
-        old_timers = getattr(prev_module, 'player_auto_next_timer', getattr(getattr(prev_module, 'helpers', None), 'player_auto_next_timer', {}))
+        # versions before song ids kept the current song's link
+        for player, current in list(helpers.player_current_song.items()):
+            if isinstance(current, str):
+                song_id = helpers.catalog.id_for_link(current)
+                if song_id is None:
+                    del helpers.player_current_song[player]
+                else:
+                    helpers.player_current_song[player] = song_id
+        prev_sessions = getattr(getattr(prev_module, 'helpers', None), 'sessions', None)
+        if prev_sessions is not None:
+            helpers.sessions.adopt(prev_sessions)
+            for session in helpers.sessions:
+                helpers.queues.joined(session.key)
+        # cancel timers of versions that used one threading.Timer per player
+        old_timers = getattr(getattr(prev_module, 'helpers', None), 'player_auto_next_timer', {})
         for t in old_timers.values():
             t.cancel()
+    if server.is_server_startup():
+        _setup_session_scoreboard(server)
 
     # ── user commands !!mp ──
     b = SimpleCommandBuilder()
@@ -152,9 +255,15 @@ def on_load(server: PluginServerInterface, prev_module):
     b.command('!!mp queue <page>', cmd_queue)
     b.command('!!mp queue search <keyword>', cmd_queue_search)
     b.command('!!mp clear', cmd_clear)
+    b.command('!!mp session', cmd_session)
+    b.command('!!mp session create <session_name>', cmd_session_create)
+    b.command('!!mp session join <session_name>', cmd_session_join)
+    b.command('!!mp session leave', cmd_session_leave)
+    b.command('!!mp radio', cmd_radio)
 
-    b.arg('keyword', Text)
+    b.arg('keyword', lambda name: Text(name).suggests(_suggest_keyword))
     b.arg('page', Integer)
+    b.arg('session_name', lambda name: Text(name).suggests(_suggest_session))
     b.register(server)
 
     # ── admin commands !!mpa ──
@@ -169,6 +278,7 @@ def on_load(server: PluginServerInterface, prev_module):
     a.command('!!mpa set <index> duration <duration_value>', cmd_admin_set_duration)
     a.command('!!mpa info', cmd_admin_info)
     a.command('!!mpa info <page>', cmd_admin_info)
+    a.command('!!mpa check', cmd_admin_check)
     a.command('!!mpa debug', cmd_admin_debug)
     a.command('!!mpa debug <target_player>', cmd_admin_debug)
     a.command('!!mpa timer <target_player> reset', cmd_admin_timer_reset)
@@ -186,3 +296,50 @@ def on_load(server: PluginServerInterface, prev_module):
     a.register(server)
 
     server.register_help_message('!!mp', tr('help_short'))
+
+
+def on_unload(server: PluginServerInterface):
+    helpers.dispatcher.flush()
+    helpers.scheduler.stop()
+    # fold journaled edits into songs.json so external tools see them
+    helpers.catalog.flush()
+    for player in set(player_current_song) | set(player_play_mode):
+        if not player.startswith(SESSION_KEY_PREFIX):  # sessions carry over in memory
+            helpers._store_player_state(player)
+    helpers.queues.flush()
+    helpers.backend.close()
+
+
+def _is_reload_output(info):
+    """The server's answer to /reload, run from the console or by a player."""
+    return info.is_from_server and not info.is_player and info.content.rstrip(']').endswith('Reloading!')
+
+
+def on_info(server: PluginServerInterface, info: Info):
+    index = helpers.function_index
+    if index is not None and info.content and _is_reload_output(info):
+        index.scan()
+    monitor = helpers.tick_monitor
+    if monitor is not None and not info.is_user and info.content and monitor.feed(info.content):
+        _apply_tick_rate()
+
+
+def on_server_startup(server: PluginServerInterface):
+    _setup_session_scoreboard(server)
+    if helpers.tick_monitor is not None:
+        helpers.tick_monitor.reset()
+        _apply_tick_rate()
+
+
+def on_player_joined(server: PluginServerInterface, player: str, info: Info):
+    helpers.queues.joined(player)
+    helpers._restore_player_state(player)
+
+
+def on_player_left(server: PluginServerInterface, player: str):
+    _leave_session(server, player, online=False)
+    # nothing to play to any more: stop auto-next, keep only what resuming needs
+    _cancel_auto_next(player)
+    helpers._store_player_state(player)
+    helpers._forget_player(player)
+    helpers.queues.left(player)
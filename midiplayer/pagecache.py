@@ -0,0 +1,50 @@
+"""Rendered library pages, shared between players."""
+import threading
+from collections import OrderedDict
+
+
+class PageCache:
+    """LRU of rendered pages (lists of RText lines) for one library version.
+
+    Keys name the page (kind, number, size, language, ...); the library
+    version is passed separately, and a new version drops every entry at
+    once, so edits never have to find the pages they affect.
+    """
+
+    def __init__(self, capacity=256):
+        self.capacity = capacity
+        self.version = None
+        self.hits = 0
+        self.misses = 0
+        self._pages = OrderedDict()  # {key: [line]}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._pages)
+
+    def get(self, version, key, render):
+        """The page for ``key``, calling ``render()`` to build it on a miss."""
+        with self._lock:
+            if version != self.version:
+                self._pages.clear()
+                self.version = version
+            lines = self._pages.get(key)
+            if lines is not None:
+                self._pages.move_to_end(key)
+                self.hits += 1
+                return lines
+            self.misses += 1
+        lines = render()
+        with self._lock:
+            if version == self.version and self.capacity > 0:
+                self._pages[key] = lines
+                while len(self._pages) > self.capacity:
+                    self._pages.popitem(last=False)
+        return lines
+
+    def clear(self):
+        with self._lock:
+            self._pages.clear()
+
+    def stats(self):
+        return len(self._pages), self.capacity, self.hits, self.misses
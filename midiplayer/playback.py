@@ -0,0 +1,74 @@
+"""Per-player playback position."""
+import time
+
+
+class PlaybackClock:
+    """Tracks how far into a song a player is, across pause and resume.
+
+    Position is in song seconds, which advance ``speed`` times as fast as
+    wall-clock seconds: 1.0 at 20 TPS, less when the server lags (see
+    :class:`~midiplayer.tickrate.TickRateMonitor`). Starts running when
+    created. ``duration`` may be None for songs whose length is unknown;
+    :meth:`remaining` is then None as well.
+    """
+
+    __slots__ = ('duration', 'speed', 'paused', '_pos', '_mark', '_wall', '_clock')
+
+    def __init__(self, duration=None, speed=1.0, clock=time.monotonic):
+        self._clock = clock
+        self.duration = duration
+        self.speed = speed
+        self.paused = False
+        self._pos = 0.0      # song seconds played up to _mark
+        self._wall = 0.0     # wall seconds played up to _mark
+        self._mark = clock()
+
+    def _advance(self):
+        now = self._clock()
+        if not self.paused:
+            self._pos += (now - self._mark) * self.speed
+            self._wall += now - self._mark
+        self._mark = now
+
+    def pause(self):
+        if not self.paused:
+            self._advance()
+            self.paused = True
+
+    def resume(self):
+        if self.paused:
+            self._advance()
+            self.paused = False
+
+    def set_speed(self, speed):
+        self._advance()
+        self.speed = speed
+
+    def position(self):
+        """Seconds of the song played so far."""
+        pos = self._pos
+        if not self.paused:
+            pos += (self._clock() - self._mark) * self.speed
+        if self.duration is not None:
+            pos = min(pos, self.duration)
+        return max(0.0, pos)
+
+    def remaining(self):
+        """Song seconds left."""
+        if self.duration is None:
+            return None
+        return max(0.0, self.duration - self.position())
+
+    def wall_remaining(self):
+        """Wall-clock seconds left at the current speed."""
+        remaining = self.remaining()
+        if remaining is None:
+            return None
+        return remaining / self.speed if self.speed > 0 else remaining
+
+    def drift(self):
+        """How many seconds the song is behind the wall clock (lag)."""
+        wall = self._wall
+        if not self.paused:
+            wall += self._clock() - self._mark
+        return wall - self.position()
@@ -0,0 +1,348 @@
+"""Per-player play queues."""
+import random
+import threading
+from collections import OrderedDict, deque
+
+from midiplayer.storage import DebouncedWriter
+
+_REMOVED = object()  # tombstone left in PlayQueue slots by remove()
+HISTORY_SIZE = 50
+
+
+class ShuffleBag:
+    """Song ids not yet drawn in the current shuffle cycle.
+
+    Drawing takes a random element and swaps the last one into its place,
+    so draws, additions and removals are all O(1).
+    """
+
+    def __init__(self, song_ids=()):
+        self._items = list(song_ids)
+        self._pos = {song_id: i for i, song_id in enumerate(self._items)}
+
+    def __len__(self):
+        return len(self._items)
+
+    def __contains__(self, song_id):
+        return song_id in self._pos
+
+    def add(self, song_id):
+        if song_id not in self._pos:
+            self._pos[song_id] = len(self._items)
+            self._items.append(song_id)
+
+    def discard(self, song_id):
+        i = self._pos.pop(song_id, None)
+        if i is None:
+            return
+        last = self._items.pop()
+        if i < len(self._items):
+            self._items[i] = last
+            self._pos[last] = i
+
+    def draw(self):
+        song_id = self._items[random.randrange(len(self._items))]
+        self.discard(song_id)
+        return song_id
+
+
+class PlayQueue:
+    """Ordered set of song ids with a cursor on the current song.
+
+    Membership, :meth:`index`, :meth:`append` and :meth:`remove` are O(1):
+    a dict maps each id to its slot, and removal leaves a tombstone that
+    is compacted away in one pass the next time positions are needed.
+    ``cursor`` is the position of the song being played, so next/prev do
+    not have to search the queue for it.
+
+    Random mode draws from a :class:`ShuffleBag` that is refilled once per
+    cycle and kept in step with appends and removals; ``history`` holds
+    the last :data:`HISTORY_SIZE` songs that were played, for prev.
+    """
+
+    def __init__(self, song_ids=()):
+        self._slots = []
+        self._pos = {}       # {song_id: slot}
+        self._removed = 0    # tombstones in _slots
+        self._cursor = None  # slot of the current song
+        self._bag = None     # ShuffleBag, created by the first draw()
+        self.history = deque(maxlen=HISTORY_SIZE)
+        self._lock = threading.RLock()
+        for song_id in song_ids:
+            self.append(song_id)
+
+    def _compact(self):
+        if not self._removed:
+            return
+        with self._lock:
+            current = self.current
+            self._slots = [song_id for song_id in self._slots if song_id is not _REMOVED]
+            self._pos = {song_id: i for i, song_id in enumerate(self._slots)}
+            self._removed = 0
+            self._cursor = self._pos.get(current)
+
+    def __len__(self):
+        return len(self._slots) - self._removed
+
+    def __bool__(self):
+        return len(self) > 0
+
+    def __contains__(self, song_id):
+        return song_id in self._pos
+
+    def __iter__(self):
+        return (song_id for song_id in list(self._slots) if song_id is not _REMOVED)
+
+    def __getitem__(self, idx):
+        self._compact()
+        return self._slots[idx]
+
+    def __eq__(self, other):
+        if isinstance(other, PlayQueue):
+            other = list(other)
+        return list(self) == other
+
+    def __repr__(self):
+        return f'PlayQueue({list(self)!r})'
+
+    def index(self, song_id):
+        self._compact()
+        return self._pos[song_id]
+
+    def append(self, song_id):
+        """Add ``song_id`` at the end; returns False if it is already queued."""
+        with self._lock:
+            if song_id in self._pos:
+                return False
+            self._pos[song_id] = len(self._slots)
+            self._slots.append(song_id)
+            if self._bag is not None:
+                self._bag.add(song_id)
+            return True
+
+    def remove(self, song_id):
+        """Remove ``song_id``; returns False if it was not queued."""
+        with self._lock:
+            slot = self._pos.pop(song_id, None)
+            if slot is None:
+                return False
+            self._slots[slot] = _REMOVED
+            self._removed += 1
+            if self._bag is not None:
+                self._bag.discard(song_id)
+            if slot == self._cursor:
+                self._cursor = None
+            if self._removed > len(self._slots) // 2:
+                self._compact()
+            return True
+
+    def shuffle(self):
+        with self._lock:
+            self._compact()
+            current = self.current
+            random.shuffle(self._slots)
+            self._pos = {song_id: i for i, song_id in enumerate(self._slots)}
+            self._cursor = self._pos.get(current)
+
+    def draw(self):
+        """Next song id of the shuffle cycle; starts a new cycle when it runs out."""
+        with self._lock:
+            if not self._bag:
+                current = self.current
+                self._bag = ShuffleBag(song_id for song_id in self if song_id != current)
+                if not self._bag:
+                    self._bag = ShuffleBag(self)
+            return self._bag.draw() if self._bag else None
+
+    def played(self, song_id, remember=True):
+        """Record that ``song_id`` started: move the cursor, take it out of the bag."""
+        with self._lock:
+            self.seek(song_id)
+            if self._bag is not None:
+                self._bag.discard(song_id)
+            if remember and (not self.history or self.history[-1] != song_id):
+                self.history.append(song_id)
+
+    @property
+    def bag_size(self):
+        return len(self._bag) if self._bag is not None else 0
+
+    # ── cursor ──
+
+    @property
+    def current(self):
+        slot = self._cursor
+        return None if slot is None else self._slots[slot]
+
+    @property
+    def cursor(self):
+        """Position of the current song, or None."""
+        self._compact()
+        return self._cursor
+
+    def seek(self, song_id):
+        """Make ``song_id`` the current song; returns its position or None."""
+        with self._lock:
+            self._compact()
+            self._cursor = self._pos.get(song_id)
+            return self._cursor
+
+    def locate(self, song_id):
+        """Position of ``song_id``, the current song; uses the cursor when it matches."""
+        if song_id is not None and song_id == self.current:
+            return self.cursor
+        return self.seek(song_id)
+
+
+class QueueManager:
+    """Keeps players' queues in memory once they have been touched.
+
+    A queue is loaded from the storage backend on first use or when its
+    player joins. At most ``capacity`` queues are cached: beyond that the
+    least recently used queues of offline players are dropped (written
+    first if they have unsaved changes). Online players are never evicted.
+
+    Mutations only mark the queue dirty; dirty queues are written to the
+    storage backend in the background by a :class:`DebouncedWriter`, and
+    synchronously by :meth:`flush` (on unload and when a player leaves).
+
+    Queues saved before songs had ids hold links; they are converted with
+    ``resolve_link`` (link -> song id or None) when first loaded, and
+    written back in the new format.
+    """
+
+    def __init__(self, backend, flush_delay=2.0, resolve_link=None, capacity=1000):
+        self.backend = backend
+        self.resolve_link = resolve_link
+        self.capacity = capacity
+        self.loads = 0
+        self.evictions = 0
+        self._queues = OrderedDict()  # {player: PlayQueue}, least recently used first
+        self._present = set()  # cached players whose queue exists in storage or was saved
+        self._online = set()
+        self._dirty = set()
+        self._lock = threading.RLock()
+        self._writer = DebouncedWriter(self._write_dirty, delay=flush_delay)
+
+    @property
+    def writer(self):
+        return self._writer
+
+    def _touch(self, player):
+        queue = self._queues.get(player)
+        if queue is not None:
+            self._queues.move_to_end(player)
+            return queue
+        self.loads += 1
+        if self.backend.has_queue(player):
+            self._present.add(player)
+            items = self.backend.load_queue(player)
+            if any(isinstance(item, str) for item in items):
+                items = self._migrate(items)
+                self._dirty.add(player)
+                self._writer.schedule()
+            queue = PlayQueue(items)
+        else:
+            queue = PlayQueue()
+        self._queues[player] = queue
+        self._evict()
+        return queue
+
+    def _evict(self):
+        over = len(self._queues) - self.capacity
+        if over <= 0:
+            return
+        victims = []
+        for player in self._queues:
+            if len(victims) >= over:
+                break
+            if player not in self._online:
+                victims.append(player)
+        for player in victims:
+            queue = self._queues.pop(player)
+            if player in self._dirty:
+                self._dirty.discard(player)
+                self.backend.save_queue(player, list(queue))
+            self._present.discard(player)
+            self.evictions += 1
+
+    def _migrate(self, items):
+        ids = []
+        for item in items:
+            if isinstance(item, str):
+                item = self.resolve_link(item) if self.resolve_link else None
+            if item is not None:
+                ids.append(item)
+        return ids
+
+    def get(self, player):
+        """The player's queue; callers that change it must call :meth:`save`."""
+        with self._lock:
+            return self._touch(player)
+
+    def has(self, player):
+        """Whether the player has a saved queue (it may be empty after clear)."""
+        with self._lock:
+            self._touch(player)
+            return player in self._present
+
+    def save(self, player, queue):
+        if not isinstance(queue, PlayQueue):
+            queue = PlayQueue(queue)
+        with self._lock:
+            self._queues[player] = queue
+            self._queues.move_to_end(player)
+            self._present.add(player)
+            self._dirty.add(player)
+            self._evict()
+        self._writer.schedule()
+
+    # ── player lifecycle ──
+
+    def joined(self, player):
+        """Pin the player's queue in memory, loading it now."""
+        with self._lock:
+            self._online.add(player)
+            self._touch(player)
+
+    def left(self, player):
+        """Write the player's queue and let it be evicted."""
+        with self._lock:
+            self._online.discard(player)
+        self.flush(player)
+
+    def drop(self, player):
+        """Delete the queue from memory and storage (a closed session's)."""
+        with self._lock:
+            self._online.discard(player)
+            self._dirty.discard(player)
+            self._present.discard(player)
+            self._queues.pop(player, None)
+            self.backend.delete(player)
+
+    # ── persistence ──
+
+    def _write_dirty(self):
+        with self._lock:
+            dirty = [(p, list(self._queues[p])) for p in self._dirty if p in self._queues]
+            self._dirty.clear()
+        for player, queue in dirty:
+            self.backend.save_queue(player, queue)
+
+    def flush(self, player=None):
+        """Write dirty queues now: one player's, or all of them."""
+        if player is None:
+            self._writer.flush()
+            return
+        with self._lock:
+            if player not in self._dirty:
+                return
+            self._dirty.discard(player)
+            queue = list(self._queues.get(player, ()))
+        self.backend.save_queue(player, queue)
+
+    def stats(self):
+        """(cached, capacity, unsaved, background writes, loads, evictions)"""
+        with self._lock:
+            return (len(self._queues), self.capacity, len(self._dirty),
+                    self._writer.writes, self.loads, self.evictions)
@@ -0,0 +1,148 @@
+"""One thread that runs every delayed callback of the plugin."""
+import heapq
+import itertools
+import threading
+import time
+
+
+class ScheduledTask:
+    """A callback waiting in a :class:`Scheduler`, found again by its key.
+
+    ``interval`` is the delay it was (re)scheduled with; ``due`` is the
+    monotonic time it fires at, or None while suspended.
+    """
+
+    __slots__ = ('key', 'callback', 'interval', 'due', 'seq')
+
+    def __init__(self, key, callback, interval):
+        self.key = key
+        self.callback = callback
+        self.interval = interval
+        self.due = None
+        self.seq = None
+
+    def is_alive(self):
+        return self.due is not None
+
+    def remaining(self, now=None):
+        if self.due is None:
+            return None
+        return max(0.0, self.due - (time.monotonic() if now is None else now))
+
+
+class Scheduler:
+    """Min-heap of :class:`ScheduledTask` driven by a single daemon thread.
+
+    There is at most one task per key. Cancelling drops the task from the
+    key map and leaves its heap entry behind to be skipped when popped;
+    rescheduling pushes a new entry. Both are O(log n) at most. Callbacks
+    run one at a time on the scheduler thread, so they must not block for
+    long and cannot call ``tr()``.
+    """
+
+    def __init__(self, logger=None, clock=time.monotonic):
+        self.logger = logger
+        self.clock = clock
+        self.fired = 0
+        self._tasks = {}  # {key: ScheduledTask}
+        self._heap = []   # [(due, seq, task)]
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._thread = None
+        self._stopped = False
+
+    def _push(self, task, delay):
+        task.due = self.clock() + delay
+        task.seq = next(self._seq)
+        heapq.heappush(self._heap, (task.due, task.seq, task))
+        # stale entries are skipped when popped; rebuild once they dominate
+        if len(self._heap) > 2 * len(self._tasks) + 64:
+            self._heap = [e for e in self._heap if self._tasks.get(e[2].key) is e[2] and e[1] == e[2].seq]
+            heapq.heapify(self._heap)
+        self._cond.notify()
+        if self._thread is None and not self._stopped:
+            self._thread = threading.Thread(target=self._run, name='MidiPlayer-scheduler', daemon=True)
+            self._thread.start()
+
+    def schedule(self, key, delay, callback):
+        """Run ``callback()`` after ``delay`` seconds, replacing any task for ``key``."""
+        with self._cond:
+            task = ScheduledTask(key, callback, delay)
+            self._tasks[key] = task
+            self._push(task, delay)
+            return task
+
+    def reschedule(self, key, delay=None):
+        """Move ``key``'s task to fire ``delay`` seconds from now (default: its interval)."""
+        with self._cond:
+            task = self._tasks.get(key)
+            if task is None:
+                return None
+            if delay is not None:
+                task.interval = delay
+            self._push(task, task.interval)
+            return task
+
+    def suspend(self, key):
+        """Keep ``key``'s task but stop it from firing until rescheduled."""
+        with self._cond:
+            task = self._tasks.get(key)
+            if task is not None:
+                task.due = None
+                task.seq = None
+            return task
+
+    def cancel(self, key):
+        with self._cond:
+            task = self._tasks.pop(key, None)
+            if task is not None:
+                task.due = None
+                task.seq = None
+            return task
+
+    def get(self, key):
+        return self._tasks.get(key)
+
+    def __len__(self):
+        return len(self._tasks)
+
+    def stop(self):
+        """Drop every task and end the thread."""
+        with self._cond:
+            self._stopped = True
+            self._tasks.clear()
+            self._heap.clear()
+            self._cond.notify()
+
+    def _next_due(self):
+        """Pop the next runnable task, or return the seconds to wait for one."""
+        while self._heap:
+            due, seq, task = self._heap[0]
+            if self._tasks.get(task.key) is not task or task.seq != seq:
+                heapq.heappop(self._heap)  # cancelled, suspended or rescheduled
+                continue
+            wait = due - self.clock()
+            if wait > 0:
+                return wait
+            heapq.heappop(self._heap)
+            del self._tasks[task.key]
+            task.due = None
+            return task
+        return None
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while True:
+                    if self._stopped:
+                        return
+                    nxt = self._next_due()
+                    if isinstance(nxt, ScheduledTask):
+                        break
+                    self._cond.wait(nxt)
+            self.fired += 1
+            try:
+                nxt.callback()
+            except Exception:
+                if self.logger is not None:
+                    self.logger.exception(f'Scheduled task {nxt.key!r} failed')
@@ -0,0 +1,468 @@
+"""Inverted-index search over the song library.
+
+Songs are looked up by position in the library list. Every name, artist
+and link is normalized once when the index is built; queries then only
+touch the index instead of re-lowercasing every field.
+"""
+import re
+from bisect import bisect_left, insort
+from difflib import SequenceMatcher
+from functools import lru_cache
+
+try:
+    from pypinyin import lazy_pinyin
+except ImportError:  # pinyin search is optional
+    lazy_pinyin = None
+
+_TOKEN_RE = re.compile(r'[^\W_]+')
+_HAN_RE = re.compile(r'[\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff]')
+_SHORT_CACHE_SIZE = 256
+
+# fuzzy matching bounds: postings visited while counting shared trigrams,
+# and how many of the best-sharing strings get a full similarity score
+FUZZY_MAX_POSTINGS = 20000
+FUZZY_MAX_CANDIDATES = 50
+FUZZY_MIN_SCORE = 0.5
+FUZZY_MIN_WORD_SCORE = 0.7  # short words reach 0.5 by sharing two letters
+
+
+def _normalize(text):
+    """Casefold, treat underscores as spaces and collapse whitespace."""
+    return ' '.join(str(text).replace('_', ' ').casefold().split())
+
+
+def _tokens(text):
+    return _TOKEN_RE.findall(text)
+
+
+def _ngrams(token, n):
+    return {token[i:i + n] for i in range(len(token) - n + 1)}
+
+
+@lru_cache(maxsize=65536)
+def _romanize(text):
+    """Return pinyin forms of the Han characters in ``text``.
+
+    Returns ``('qing hua ci', 'qinghuaci', 'qhc')`` for ``'青花瓷'``, or an
+    empty tuple if the text has no Han characters or pypinyin is missing.
+    Cached per string, so rebuilding the index after an edit only
+    romanizes the names that actually changed.
+    """
+    if lazy_pinyin is None or not _HAN_RE.search(text):
+        return ()
+    syllables = [p for p in lazy_pinyin(text, errors='ignore') if p]
+    if not syllables:
+        return ()
+    return ' '.join(syllables), ''.join(syllables), ''.join(p[0] for p in syllables)
+
+
+def _trigrams(text):
+    padded = f'  {text} '
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def _intersect(sets):
+    """Intersect id sets, smallest first; an empty list yields an empty set."""
+    if not sets:
+        return set()
+    sets = sorted(sets, key=len)
+    result = set(sets[0])
+    for s in sets[1:]:
+        if not result:
+            break
+        result &= s
+    return result
+
+
+class SearchEngine:
+    """Token index over name, artist and link of every song.
+
+    Names and artists containing Chinese characters are also indexed by
+    their full pinyin and pinyin initials (needs ``pypinyin``).
+
+    Results are ranked in three tiers, each kept in library order:
+
+    1. exact   - the query equals a whole name, artist or link
+    2. prefix  - every query word starts some word of the song
+    3. substring - every query word occurs inside some word of the song
+
+    Library edits are applied with :meth:`add`, :meth:`remove` and
+    :meth:`replace`, which only touch the edited song's keys. The index
+    refers to songs by slot, which is their position until the first
+    removal; after that ``_slots``/``_positions`` translate between the two.
+    """
+
+    def __init__(self, songs):
+        self.songs = songs
+        self._exact = {}     # {normalized field: {slot}}
+        self._postings = {}  # {token: {slot}}
+        self._grams = {}     # {2/3-gram: {token}}
+        self._short = {}     # {1-char query: {slot}}, bounded cache
+        self._fuzzy = None   # (strings, {string: {slot}}, {word: {slot}}, {trigram: [string index]}), built lazily
+        self._slots = None      # [slot] by position, None while slot == position
+        self._positions = None  # {slot: position}, None while slot == position
+        self._next_slot = len(songs)
+        for i, song in enumerate(songs):
+            self._add(i, song)
+        self._vocab = sorted(self._postings)
+        for token in self._vocab:
+            self._add_grams(token)
+
+    def _keys(self, song):
+        """Normalized strings to index for ``song``."""
+        yield song.name_key
+        yield song.link_key
+        yield from song.artist_keys
+        for text in (song.name, *song.artist):
+            yield from _romanize(text)
+
+    def _add(self, slot, song):
+        """Index ``song`` under ``slot``; returns tokens that are new to the vocabulary."""
+        new = []
+        for key in self._keys(song):
+            if not key:
+                continue
+            self._exact.setdefault(key, set()).add(slot)
+            for token in _tokens(key):
+                ids = self._postings.get(token)
+                if ids is None:
+                    ids = self._postings[token] = set()
+                    new.append(token)
+                ids.add(slot)
+        return new
+
+    def _discard(self, slot, song):
+        """Take ``song`` out of the index; returns tokens no song uses any more."""
+        gone = []
+        for key in self._keys(song):
+            if not key:
+                continue
+            ids = self._exact.get(key)
+            if ids is not None:
+                ids.discard(slot)
+                if not ids:
+                    del self._exact[key]
+            for token in _tokens(key):
+                ids = self._postings.get(token)
+                if ids is None:
+                    continue
+                ids.discard(slot)
+                if not ids:
+                    del self._postings[token]
+                    gone.append(token)
+        return gone
+
+    def _add_grams(self, token):
+        for n in (2, 3):
+            for g in _ngrams(token, n):
+                self._grams.setdefault(g, set()).add(token)
+
+    def _update_vocab(self, new, gone):
+        for token in new:
+            insort(self._vocab, token)
+            self._add_grams(token)
+        for token in gone:
+            del self._vocab[bisect_left(self._vocab, token)]
+            for n in (2, 3):
+                for g in _ngrams(token, n):
+                    tokens = self._grams[g]
+                    tokens.discard(token)
+                    if not tokens:
+                        del self._grams[g]
+        self._short.clear()  # cached unions miss the edited song either way
+
+    def _position(self, slot):
+        return slot if self._positions is None else self._positions[slot]
+
+    def _slot(self, position):
+        return position if self._slots is None else self._slots[position]
+
+    # ── edits ──
+
+    def add(self, songs):
+        """Index the last song of ``songs``, the library after an append."""
+        slot = self._next_slot
+        self._next_slot += 1
+        song = songs[-1]
+        self.songs = songs
+        if self._slots is not None:
+            self._slots.append(slot)
+            self._positions[slot] = len(songs) - 1
+        self._update_vocab(self._add(slot, song), ())
+        self._fuzzy_add(slot, song)
+
+    def remove(self, index, songs):
+        """Drop the song at ``index``; ``songs`` is the library without it.
+
+        Later songs move up one position, so the slot -> position map is
+        rebuilt: O(n), but only integer work, no re-normalizing.
+        """
+        if self._slots is None:
+            self._slots = list(range(len(self.songs)))
+        slot = self._slots.pop(index)
+        song = self.songs[index]
+        self.songs = songs
+        self._positions = {s: i for i, s in enumerate(self._slots)}
+        self._update_vocab((), self._discard(slot, song))
+        self._fuzzy_discard(slot, song)
+
+    def replace(self, index, songs):
+        """Re-index the song at ``index``, which ``songs`` holds in its edited form."""
+        slot = self._slot(index)
+        old, song = self.songs[index], songs[index]
+        self.songs = songs
+        gone = self._discard(slot, old)
+        new = self._add(slot, song)
+        self._update_vocab([t for t in new if t not in gone], [t for t in gone if t not in new])
+        self._fuzzy_discard(slot, old)
+        self._fuzzy_add(slot, song)
+
+    # ── per-word lookups ──
+
+    def _prefix_ids(self, word):
+        ids = set()
+        lo = bisect_left(self._vocab, word)
+        for vi in range(lo, len(self._vocab)):
+            token = self._vocab[vi]
+            if not token.startswith(word):
+                break
+            ids |= self._postings[token]
+        return ids
+
+    def _substring_ids(self, word):
+        if len(word) == 1:
+            ids = self._short.get(word)
+            if ids is None:
+                ids = set()
+                for token in self._vocab:
+                    if word in token:
+                        ids |= self._postings[token]
+                if len(self._short) >= _SHORT_CACHE_SIZE:
+                    self._short.clear()
+                self._short[word] = ids
+            return ids
+        n = 2 if len(word) == 2 else 3
+        candidates = _intersect([self._grams.get(g, set()) for g in _ngrams(word, n)])
+        ids = set()
+        for token in candidates:
+            if word in token:
+                ids |= self._postings[token]
+        return ids
+
+    # ── queries ──
+
+    def _sorted(self, slots):
+        """Library positions of ``slots``, in library order."""
+        return sorted(slots if self._positions is None else map(self._positions.__getitem__, slots))
+
+    def search_tiers(self, query):
+        """Return (exact, prefix, substring) lists of song indexes."""
+        q = _normalize(query)
+        if not q:
+            return [], [], []
+        exact = self._exact.get(q, set())
+        words = _tokens(q)
+        if not words:
+            return self._sorted(exact), [], []
+        prefix = _intersect([self._prefix_ids(w) for w in words]) - exact
+        substring = _intersect([self._substring_ids(w) for w in words]) - exact - prefix
+        return self._sorted(exact), self._sorted(prefix), self._sorted(substring)
+
+    def search(self, query):
+        """Return ranked [(index, song)] matches for ``query``."""
+        return [(i, self.songs[i]) for tier in self.search_tiers(query) for i in tier]
+
+    # ── fuzzy matching ──
+
+    def _fuzzy_index(self):
+        """Whole names/artists and each of their words, so a typo in one
+        word of a long title still finds a close string to compare with."""
+        if self._fuzzy is None:
+            owners = {}  # {whole name/artist: {slot}}
+            word_owners = {}  # {word of a name/artist: {slot}}
+            for position, song in enumerate(self.songs):
+                slot = self._slot(position)
+                for key, words in self._fuzzy_keys(song):
+                    owners.setdefault(key, set()).add(slot)
+                    for word in words:
+                        word_owners.setdefault(word, set()).add(slot)
+            strings = list(owners.keys() | word_owners.keys())
+            grams = {}
+            for si, key in enumerate(strings):
+                for g in _trigrams(key):
+                    grams.setdefault(g, []).append(si)
+            self._fuzzy = strings, owners, word_owners, grams
+        return self._fuzzy
+
+    @staticmethod
+    def _fuzzy_keys(song):
+        """(name or artist, its words worth comparing on their own) for ``song``."""
+        for key in (song.name_key, *song.artist_keys):
+            if key:
+                yield key, [token for token in _tokens(key) if len(token) > 2]
+
+    def _fuzzy_add(self, slot, song):
+        if self._fuzzy is None:
+            return
+        strings, owners, word_owners, grams = self._fuzzy
+        for key, words in self._fuzzy_keys(song):
+            for string, table in ((key, owners), *((word, word_owners) for word in words)):
+                if string not in owners and string not in word_owners:
+                    strings.append(string)
+                    for g in _trigrams(string):
+                        grams.setdefault(g, []).append(len(strings) - 1)
+                table.setdefault(string, set()).add(slot)
+
+    def _fuzzy_discard(self, slot, song):
+        """Strings stay in the fuzzy index once added; their owner sets may empty."""
+        if self._fuzzy is None:
+            return
+        _, owners, word_owners, _ = self._fuzzy
+        for key, words in self._fuzzy_keys(song):
+            owners.get(key, set()).discard(slot)
+            for word in words:
+                word_owners.get(word, set()).discard(slot)
+
+    def fuzzy(self, query, limit=8):
+        """Return up to ``limit`` [(index, song)] names/artists similar to ``query``.
+
+        Candidates are narrowed by shared trigrams first; only the best
+        :data:`FUZZY_MAX_CANDIDATES` strings are scored with SequenceMatcher.
+        A song scores the better of its closest whole name/artist and the
+        average, over the query's words, of its closest word (the latter
+        only counts from :data:`FUZZY_MIN_WORD_SCORE`).
+        """
+        q = _normalize(query)
+        if not q:
+            return []
+        strings, owners, word_owners, grams = self._fuzzy_index()
+        words = _tokens(q)
+        q_grams = _trigrams(q).union(*map(_trigrams, words))
+        shared = {}
+        visited = 0
+        # rare trigrams first: they are the most selective and cheapest
+        for g in sorted(q_grams, key=lambda g: len(grams.get(g, ()))):
+            postings = grams.get(g, ())
+            visited += len(postings)
+            if visited > FUZZY_MAX_POSTINGS:
+                break
+            for si in postings:
+                shared[si] = shared.get(si, 0) + 1
+        if not shared:
+            return []
+
+        def dice(si):
+            return 2 * shared[si] / (len(q_grams) + len(strings[si]) + 1)
+
+        candidates = sorted(shared, key=dice, reverse=True)[:FUZZY_MAX_CANDIDATES]
+        best = {}
+        word_best = {}  # {song index: [best ratio per query word]}
+        for si in candidates:
+            string = strings[si]
+            if string in owners:
+                score = SequenceMatcher(None, q, string).ratio()
+                if score >= FUZZY_MIN_SCORE:
+                    for i in owners[string]:
+                        best[i] = max(best.get(i, 0), score)
+            if words and string in word_owners:
+                ratios = [SequenceMatcher(None, w, string).ratio() for w in words]
+                for i in word_owners[string]:
+                    per_word = word_best.setdefault(i, [0.0] * len(words))
+                    per_word[:] = map(max, per_word, ratios)
+        for i, per_word in word_best.items():
+            score = sum(per_word) / len(per_word)
+            if score >= FUZZY_MIN_WORD_SCORE:
+                best[i] = max(best.get(i, 0), score)
+        scores = {self._position(slot): score for slot, score in best.items()}
+        ranked = sorted(scores, key=lambda i: (-scores[i], i))[:limit]
+        return [(i, self.songs[i]) for i in ranked]
+
+
+class SuggestionTrie:
+    """Character trie over song names and links for command completion.
+
+    Nodes exist down to :data:`TRIE_DEPTH` characters. Each node keeps the
+    first ``limit`` completions below it, so short prefixes are answered
+    straight from the node; the deepest nodes also keep every completion
+    below them, which longer prefixes filter until ``limit`` are found.
+
+    Appended songs can be added in place with :meth:`add`; taking a
+    completion out would mean refilling every ``top`` list above it, so
+    removals and renames rebuild the trie instead.
+    """
+
+    TRIE_DEPTH = 4
+
+    def __init__(self, songs, limit=20):
+        self.limit = limit
+        self._root = self._node()
+        seen = set()
+        for song in songs:
+            for completion in self._completions(song):
+                if completion not in seen:
+                    seen.add(completion)
+                    self._insert(completion)
+
+    @staticmethod
+    def _completions(song):
+        for text in (song.name, song.link):
+            # Text arguments stop at spaces; commands turn '_' back into ' '
+            completion = str(text).replace(' ', '_')
+            if completion:
+                yield completion
+
+    def add(self, song):
+        """Add the completions of a song appended to the library."""
+        for completion in self._completions(song):
+            if not self._contains(completion):
+                self._insert(completion)
+
+    def _contains(self, completion):
+        key = completion.casefold()
+        node = self._root
+        for ch in key[:self.TRIE_DEPTH]:
+            node = node['children'].get(ch)
+            if node is None:
+                return False
+        if len(key) >= self.TRIE_DEPTH:
+            return (key, completion) in node['all']
+        # a short completion missing from a full top list is not offered anywhere above either
+        return completion in node['top']
+
+    @staticmethod
+    def _node():
+        return {'children': {}, 'top': [], 'all': None}
+
+    def _insert(self, completion):
+        key = completion.casefold()
+        node = self._root
+        self._offer(node, completion)
+        for depth, ch in enumerate(key[:self.TRIE_DEPTH], 1):
+            node = node['children'].setdefault(ch, self._node())
+            self._offer(node, completion)
+            if depth == self.TRIE_DEPTH:
+                if node['all'] is None:
+                    node['all'] = []
+                node['all'].append((key, completion))
+
+    def _offer(self, node, completion):
+        if len(node['top']) < self.limit:
+            node['top'].append(completion)
+
+    def complete(self, prefix):
+        """Return at most ``limit`` completions starting with ``prefix`` (case-insensitive)."""
+        key = prefix.replace(' ', '_').casefold()
+        node = self._root
+        for ch in key[:self.TRIE_DEPTH]:
+            node = node['children'].get(ch)
+            if node is None:
+                return []
+        if len(key) <= self.TRIE_DEPTH:
+            return list(node['top'])
+        result = []
+        for full, completion in node['all'] or ():
+            if full.startswith(key):
+                result.append(completion)
+                if len(result) >= self.limit:
+                    break
+        return result
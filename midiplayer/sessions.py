@@ -0,0 +1,112 @@
+"""Shared listening sessions: one playback stream for many players."""
+import re
+
+OBJECTIVE = 'mp_session'       # scoreboard objective holding each member's session number
+KEY_PREFIX = 'session:'        # ':' never appears in a player name
+NAME_PATTERN = re.compile(r'[A-Za-z0-9_]{1,16}')
+RADIO = 'radio'                # the server-owned session behind !!mp radio
+RADIO_KEY = KEY_PREFIX + RADIO
+
+
+class Session:
+    """A named group of players that listen to the same queue.
+
+    The session is the playback target: its queue, play mode, current
+    song, clock and auto-next task are stored under :attr:`key` exactly
+    like a solo player's are under the player name. Members carry the
+    session's number in the :data:`OBJECTIVE` scoreboard, so one
+    ``execute as <selector>`` reaches all of them.
+    """
+
+    __slots__ = ('name', 'number', 'owner', 'members')
+
+    def __init__(self, name, number, owner):
+        self.name = name
+        self.number = number
+        self.owner = owner
+        self.members = set()
+
+    @property
+    def key(self):
+        return KEY_PREFIX + self.name
+
+    @property
+    def selector(self):
+        return f'@a[scores={{{OBJECTIVE}={self.number}}}]'
+
+    def __repr__(self):
+        return f'Session({self.name!r}, {self.number!r}, members={sorted(self.members)!r})'
+
+
+class SessionRegistry:
+    """Every open session, by name and by member."""
+
+    def __init__(self):
+        self._by_name = {}    # {name: Session}
+        self._by_player = {}  # {player: Session}
+        self._next_number = 1
+
+    def __len__(self):
+        return len(self._by_name)
+
+    def __iter__(self):
+        return iter(list(self._by_name.values()))
+
+    def get(self, name):
+        return self._by_name.get(name)
+
+    def of(self, player):
+        """The session ``player`` is in, or None."""
+        return self._by_player.get(player)
+
+    def by_key(self, key):
+        if not key.startswith(KEY_PREFIX):
+            return None
+        return self._by_name.get(key[len(KEY_PREFIX):])
+
+    def create(self, name, owner):
+        """Open a session (``owner`` None for the server's); returns None if the name is taken."""
+        if name in self._by_name:
+            return None
+        session = Session(name, self._next_number, owner)
+        self._next_number += 1
+        self._by_name[name] = session
+        return session
+
+    def join(self, player, session):
+        """Put ``player`` in ``session``; returns the session they were in before."""
+        previous = self.leave(player)[0]
+        session.members.add(player)
+        self._by_player[player] = session
+        return previous
+
+    def leave(self, player):
+        """Take ``player`` out of their session.
+
+        Returns ``(session, closed)``; the session is closed once its last
+        member leaves. ``(None, False)`` if they were not in one.
+        """
+        session = self._by_player.pop(player, None)
+        if session is None:
+            return None, False
+        session.members.discard(player)
+        if session.members:
+            return session, False
+        del self._by_name[session.name]
+        return session, True
+
+    def target(self, player):
+        """Playback key for ``player``: their session's, or their own name."""
+        session = self._by_player.get(player)
+        return session.key if session else player
+
+    def selector(self, target):
+        """Entity selector that reaches everyone listening to ``target``."""
+        session = self.by_key(target)
+        return session.selector if session else target
+
+    def adopt(self, other):
+        """Take over the sessions of a registry from before a reload."""
+        self._by_name.update(other._by_name)
+        self._by_player.update(other._by_player)
+        self._next_number = max(self._next_number, other._next_number)
@@ -0,0 +1,129 @@
+"""Compact in-memory song record."""
+import sys
+
+from midiplayer.search import _normalize
+
+_FIELDS = ('id', 'name', 'link', 'artist', 'duration')
+
+
+def _key(text):
+    """Normalized search key; shares the original string when nothing changes."""
+    key = _normalize(text)
+    return text if key == text else key
+
+
+def _ids_by_link(pairs):
+    """{link: [id, ...]} from (link, id) pairs, ids in the order given."""
+    known = {}
+    for link, song_id in pairs:
+        if song_id is not None:
+            known.setdefault(link, []).append(song_id)
+    return known
+
+
+def _assign_ids(songs, next_id, known=None):
+    """Give songs without a (unique) id one, in place.
+
+    A song takes an id ``known`` ({link: [id]}, see :func:`_ids_by_link`)
+    lists for its link if no other song has it, else the next one from
+    ``next_id`` up (but past every id already in ``songs``). Returns
+    ``(changed, next_id)``.
+    """
+    taken = {s.id for s in songs if s.id is not None}
+    next_id = max(next_id, max(taken, default=0) + 1)
+    known = {link: list(ids) for link, ids in (known or {}).items()}
+    seen = set()
+    changed = False
+    for song in songs:
+        if song.id is None or song.id in seen:
+            candidates = known.get(song.link, [])
+            reuse = next((i for i in candidates if i not in taken), None)
+            if reuse is not None:
+                candidates.remove(reuse)
+                song.id = reuse
+            else:
+                song.id = next_id
+                next_id += 1
+            taken.add(song.id)
+            changed = True
+        seen.add(song.id)
+    return changed, next_id
+
+
+class Song:
+    """One library entry.
+
+    Uses ``__slots__`` instead of a per-song dict, interns artist names
+    (the same artist usually appears on many songs) and precomputes the
+    normalized keys the search index needs. ``id`` is the stable number
+    queues refer to; it is assigned by the catalog and never reused.
+    :meth:`from_dict` and :meth:`to_dict` keep the songs.json format
+    unchanged; keys this class does not know about are carried along in
+    ``extra``.
+    """
+
+    __slots__ = ('id', 'name', 'link', 'artist', 'duration', 'extra', 'name_key', 'link_key', 'artist_keys')
+
+    def __init__(self, name, link, artist=(), duration=None, extra=None, song_id=None):
+        self.id = song_id
+        self.extra = extra
+        self.duration = duration
+        self._set_name(name)
+        self._set_link(link)
+        self._set_artist(artist)
+
+    def _set_name(self, name):
+        self.name = name
+        self.name_key = _key(name)
+
+    def _set_link(self, link):
+        self.link = link
+        self.link_key = _key(link)
+
+    def _set_artist(self, artist):
+        self.artist = tuple(sys.intern(str(a)) for a in artist)
+        keys = tuple(sys.intern(_key(a)) for a in self.artist)
+        self.artist_keys = self.artist if keys == self.artist else keys
+
+    def update(self, **fields):
+        """Set name/link/artist/duration, keeping the search keys in sync."""
+        for field, value in fields.items():
+            if field == 'name':
+                self._set_name(value)
+            elif field == 'link':
+                self._set_link(value)
+            elif field == 'artist':
+                self._set_artist(value)
+            elif field == 'duration':
+                self.duration = value
+            else:
+                self.extra = {**(self.extra or {}), field: value}
+
+    def copy(self, keep_id=False):
+        """A copy, by default without an id (the catalog gives it a new one when added)."""
+        return Song(self.name, self.link, self.artist, self.duration, dict(self.extra) if self.extra else None,
+                    self.id if keep_id else None)
+
+    @classmethod
+    def from_dict(cls, data):
+        extra = {k: v for k, v in data.items() if k not in _FIELDS} or None
+        return cls(data.get('name', ''), data.get('link', ''), data.get('artist', ()), data.get('duration'), extra, data.get('id'))
+
+    def to_dict(self):
+        data = {} if self.id is None else {'id': self.id}
+        data.update(name=self.name, link=self.link, artist=list(self.artist))
+        if self.duration is not None:
+            data['duration'] = self.duration
+        if self.extra:
+            data.update(self.extra)
+        return data
+
+    def __eq__(self, other):
+        if not isinstance(other, Song):
+            return NotImplemented
+        return self.to_dict() == other.to_dict()
+
+    __hash__ = None
+
+    def __repr__(self):
+        return f'Song({self.id!r}, {self.name!r}, {self.link!r}, {list(self.artist)!r}, {self.duration!r})'
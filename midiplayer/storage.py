@@ -0,0 +1,673 @@
+"""Storage backends for the song library and player queues.
+
+:class:`JsonBackend` keeps songs in songs.json and all player queues in
+a small queues.db; :class:`SqliteBackend` keeps everything in a single
+WAL-mode database. Both take the same journal-style edit records
+that :class:`~midiplayer.helpers.SongCatalog` produces.
+"""
+import glob
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+
+from midiplayer.song import Song, _assign_ids, _ids_by_link
+
+
+def _dump_json(data, pretty=False):
+    if pretty:
+        return json.dumps(data, ensure_ascii=False, indent=4)
+    return json.dumps(data, ensure_ascii=False, separators=(',', ':'))
+
+
+def _atomic_write(path, text):
+    """Write ``text`` to a temp file next to ``path`` and swap it into place.
+
+    A crash mid-write leaves either the old file or the new one, never a
+    truncated mix of both.
+    """
+    tmp = f'{path}.tmp'
+    with open(tmp, 'w', encoding='utf-8') as f:
+        f.write(text)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+class DebouncedWriter:
+    """Write-behind helper that coalesces saves.
+
+    :meth:`schedule` marks the data dirty and arms a timer on the first
+    call; further calls inside the window are folded into the same write.
+    ``write`` is called at flush time and must persist the newest state.
+    """
+
+    def __init__(self, write, delay=2.0):
+        self.delay = delay
+        self.writes = 0
+        self.coalesced = 0
+        self._write = write
+        self._dirty = False
+        self._timer = None
+        self._lock = threading.Lock()     # guards _dirty/_timer
+        self._io_lock = threading.Lock()  # serializes writes
+
+    @property
+    def pending(self):
+        return self._dirty
+
+    def schedule(self):
+        with self._lock:
+            if self._dirty:
+                self.coalesced += 1
+                return
+            self._dirty = True
+            if self.delay > 0:
+                self._timer = threading.Timer(self.delay, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+        if self.delay <= 0:
+            self.flush()
+
+    def flush(self):
+        """Write now if there are unsaved changes. Safe to call from any thread.
+
+        ``write`` runs without holding the dirty-flag lock, so it may take
+        locks of its own that are also held while calling :meth:`schedule`.
+        """
+        with self._io_lock:
+            with self._lock:
+                if self._timer is not None:
+                    self._timer.cancel()
+                    self._timer = None
+                if not self._dirty:
+                    return
+                self._dirty = False
+            self._write()
+            self.writes += 1
+
+
+class Journal:
+    """Append-only JSON-lines log of edits made on top of a snapshot file.
+
+    The first line names the snapshot it belongs to (a content hash), so a
+    journal left behind by a crash during compaction, or a snapshot that
+    was replaced by hand, is detected and ignored instead of replayed twice.
+    The header can carry extra fields (``header``) that belong to the snapshot.
+
+    Records are not thrown away when the journal is folded into a new
+    snapshot: :meth:`archive` appends them to ``archive_path``, which keeps
+    the full history of edits (who and when) across compactions.
+    """
+
+    def __init__(self, path, archive_path=None):
+        self.path = path
+        self.archive_path = archive_path
+        self.records = 0
+        self.dropped = 0  # records of the last replay that belonged to another snapshot
+        self.header = {}
+        self._file = None
+
+    @property
+    def size(self):
+        try:
+            return os.path.getsize(self.path)
+        except OSError:
+            return 0
+
+    def replay(self, base):
+        """Return the records logged on top of snapshot ``base``.
+
+        Returns None when there is no journal or it belongs to another
+        snapshot; in the latter case :attr:`dropped` counts its records.
+        """
+        self.close()
+        self.dropped = 0
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                lines = f.read().splitlines()
+        except OSError:
+            return None
+        try:
+            header = json.loads(lines[0])
+        except (IndexError, ValueError):
+            return None
+        if not isinstance(header, dict) or header.get('base') != base:
+            self.dropped = sum(1 for line in lines[1:] if line)
+            return None
+        self.header = header
+        records = []
+        torn = False
+        for line in lines[1:]:
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                # a crash mid-append leaves a partial last line
+                torn = True
+                break
+        if torn:
+            self._rewrite(header, records)
+        self.records = len(records)
+        return records
+
+    def reset(self, base, **fields):
+        """Start an empty journal on top of snapshot ``base``."""
+        self._rewrite({'base': base, **fields}, [])
+
+    def archive(self):
+        """Append the journal's records to the archive file; returns how many."""
+        if self.archive_path is None:
+            return 0
+        self.close()
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                lines = f.read().splitlines()[1:]
+        except OSError:
+            return 0
+        records = []
+        for line in lines:
+            try:
+                json.loads(line)
+            except ValueError:
+                continue  # torn last line
+            records.append(line + '\n')
+        if records:
+            with open(self.archive_path, 'a', encoding='utf-8') as f:
+                f.writelines(records)
+                f.flush()
+                os.fsync(f.fileno())
+        return len(records)
+
+    def _rewrite(self, header, records):
+        self.close()
+        self.header = header
+        lines = [_dump_json(header)] + [_dump_json(r) for r in records]
+        _atomic_write(self.path, '\n'.join(lines) + '\n')
+        self.records = len(records)
+
+    def append(self, record):
+        if self._file is None:
+            self._file = open(self.path, 'a', encoding='utf-8')
+        self._file.write(_dump_json(record) + '\n')
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self.records += 1
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+def _apply_record(songs, record):
+    """Apply one edit record to a song list in place."""
+    op = record.get('op')
+    if op == 'add':
+        songs.append(Song.from_dict(record['song']))
+    elif op == 'del':
+        songs.pop(record['index'])
+    elif op == 'set':
+        songs[record['index']].update(**record['fields'])
+
+
+def _file_stamp(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return st.st_mtime_ns, st.st_size
+
+
+# ── JSON files ──
+
+class JsonBackend:
+    """songs.json snapshot + songs.journal; queues live in a :class:`QueueDatabase`.
+
+    The journal header also remembers the next free song id, so the id of
+    the newest song stays retired after that song is deleted. Folded
+    journal records are kept in songs.audit.log.
+
+    songs.json may be rewritten without ids by the CLI/GUI tool, which
+    also invalidates the journal. So the queue database keeps a copy of
+    every song's id by link and the next free id; :meth:`known_ids`
+    hands them to the catalog, which gives songs their old ids back.
+    """
+
+    name = 'json'
+    paged = False  # paging needs the parsed file, the catalog slices its own copy
+
+    def __init__(self, songs_path, queues_path, compact_bytes=65536, pretty=False, logger=None):
+        self.songs_path = songs_path
+        self.queues = QueueDatabase(queues_path)
+        self.compact_bytes = compact_bytes
+        self.pretty = pretty
+        self.logger = logger
+        self.compactions = 0
+        self._next_id = 1
+        self._known = {}
+        stem = os.path.splitext(songs_path)[0]
+        self.journal = Journal(f'{stem}.journal', f'{stem}.audit.log')
+        self._ensure_songs_file()
+
+    def _ensure_songs_file(self):
+        if not os.path.exists(self.songs_path):
+            _atomic_write(self.songs_path, '[]')
+
+    def stamp(self):
+        """Changes whenever songs.json is replaced, by us or by hand."""
+        return _file_stamp(self.songs_path)
+
+    def load(self):
+        self._ensure_songs_file()
+        with open(self.songs_path, 'rb') as f:
+            raw = f.read()
+        songs = [Song.from_dict(d) for d in json.loads(raw.decode('utf-8'))]
+        base = hashlib.sha1(raw).hexdigest()
+        records = self.journal.replay(base)
+        self._known, stored_next_id = self.queues.load_song_ids()
+        self._next_id = max(stored_next_id, 1 if records is None else self.journal.header.get('next_id', 1))
+        self._see_ids(songs)
+        if records is None:
+            if all(s.id is not None for s in songs):
+                # otherwise the catalog assigns ids and compacts, which saves them
+                self.queues.save_song_ids(songs, self._next_id)
+            if self.journal.dropped:
+                if self.logger is not None:
+                    self.logger.warning(
+                        f'{os.path.basename(self.songs_path)} was replaced outside the plugin; '
+                        f'{self.journal.dropped} journaled edits not yet saved to it were discarded '
+                        f'(kept in {os.path.basename(self.journal.archive_path)})'
+                    )
+                self.journal.archive()
+            self.journal.reset(base, next_id=self._next_id)
+        else:
+            for record in records:
+                _apply_record(songs, record)
+                self._see(record)
+        return songs
+
+    def _see_ids(self, songs):
+        ids = [s.id for s in songs if s.id is not None]
+        self._next_id = max(self._next_id, max(ids, default=0) + 1)
+
+    def _see(self, record):
+        if record.get('op') == 'add' and record['song'].get('id') is not None:
+            self._next_id = max(self._next_id, record['song']['id'] + 1)
+
+    def next_id(self):
+        """Lowest song id that was never handed out."""
+        return self._next_id
+
+    def known_ids(self):
+        """{link: [id]} of the songs as last saved by the plugin."""
+        return self._known
+
+    def record(self, record):
+        """Persist an edit. Returns True once the journal is due for compaction."""
+        self._see(record)
+        self.journal.append(record)
+        if record.get('op') == 'add' and record['song'].get('id') is not None:
+            self.queues.remember_song_id(record['song']['id'], record['song'].get('link', ''), self._next_id)
+        return self.journal.size >= self.compact_bytes
+
+    def replace(self, songs):
+        self.compact(songs)
+
+    def compact(self, songs):
+        """Fold the journal into a fresh songs.json snapshot."""
+        text = _dump_json([s.to_dict() for s in songs], pretty=self.pretty)
+        # archive first: a crash before the reset may log records twice, but never loses them
+        self.journal.archive()
+        _atomic_write(self.songs_path, text)
+        self._see_ids(songs)
+        self.journal.reset(hashlib.sha1(text.encode('utf-8')).hexdigest(), next_id=self._next_id)
+        self.queues.save_song_ids(songs, self._next_id)
+        self._known = _ids_by_link((s.link, s.id) for s in songs)
+        self.compactions += 1
+
+    def flush(self, songs):
+        if songs is not None and self.journal.records:
+            self.compact(songs)
+
+    def close(self):
+        self.journal.close()
+        self.queues.close()
+
+
+# ── SQLite ──
+
+_QUEUE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS queues (
+    player TEXT PRIMARY KEY,
+    data TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS player_state (
+    player TEXT PRIMARY KEY,
+    mode TEXT,
+    current INTEGER
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+CREATE TABLE IF NOT EXISTS song_ids (
+    id INTEGER PRIMARY KEY,
+    link TEXT NOT NULL
+);
+"""
+
+
+def _connect(db_path):
+    conn = sqlite3.connect(db_path, check_same_thread=False)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    return conn
+
+
+class QueueDatabase:
+    """All players' queues in one SQLite file, keyed by player name.
+
+    Also holds what an offline player was doing (play mode and current song),
+    so it can be restored when they join again.
+
+    Replaces the old one-file-per-player ``queues/`` directory, which
+    :meth:`import_dir` reads in once. :class:`SqliteBackend` passes its own
+    connection and lock so queues live in the same database as the songs.
+
+    For :class:`JsonBackend` it also remembers the song ids of songs.json
+    (``song_ids`` and the ``next_song_id`` meta row).
+    """
+
+    def __init__(self, db_path, conn=None, lock=None):
+        self.db_path = db_path
+        self._lock = lock or threading.RLock()
+        self._conn = conn or _connect(db_path)
+        self._conn.executescript(_QUEUE_SCHEMA)
+        self._conn.commit()
+
+    def import_dir(self, queues_dir, logger=None):
+        """Copy queues/<player>.json files in once; returns how many were imported.
+
+        Unreadable files (the old writer could leave them truncated) are
+        skipped and left in place, so one bad queue doesn't block the rest.
+        """
+        with self._lock:
+            done = self._conn.execute("SELECT value FROM meta WHERE key = 'imported_dir'").fetchone()
+            if done:
+                return 0
+            count = 0
+            with self._conn:
+                for path in glob.glob(os.path.join(queues_dir, '*.json')):
+                    player = os.path.splitext(os.path.basename(path))[0]
+                    try:
+                        with open(path, 'r', encoding='utf-8') as f:
+                            queue = json.load(f)
+                        if not isinstance(queue, list):
+                            raise ValueError('not a list')
+                    except (OSError, ValueError) as e:
+                        if logger is not None:
+                            logger.warning(f'Skipped the queue of {player}: {os.path.basename(path)} is unreadable ({e})')
+                        continue
+                    self._conn.execute(
+                        'INSERT OR IGNORE INTO queues (player, data) VALUES (?, ?)',
+                        (player, _dump_json(queue)),
+                    )
+                    count += 1
+                self._conn.execute("INSERT INTO meta (key, value) VALUES ('imported_dir', '1')")
+            return count
+
+    def load_song_ids(self):
+        """({link: [id]}, next free id) as last saved; ({}, 1) if nothing was."""
+        with self._lock:
+            rows = self._conn.execute('SELECT link, id FROM song_ids ORDER BY id').fetchall()
+            row = self._conn.execute("SELECT value FROM meta WHERE key = 'next_song_id'").fetchone()
+        return _ids_by_link(rows), int(row[0]) if row else 1
+
+    def save_song_ids(self, songs, next_id):
+        """Replace the remembered ids with those of ``songs``."""
+        with self._lock, self._conn:
+            self._conn.execute('DELETE FROM song_ids')
+            self._conn.executemany(
+                'INSERT OR REPLACE INTO song_ids (id, link) VALUES (?, ?)',
+                [(s.id, s.link) for s in songs if s.id is not None],
+            )
+            self._save_next_song_id(next_id)
+
+    def remember_song_id(self, song_id, link, next_id):
+        with self._lock, self._conn:
+            self._conn.execute('INSERT OR REPLACE INTO song_ids (id, link) VALUES (?, ?)', (song_id, link))
+            self._save_next_song_id(next_id)
+
+    def _save_next_song_id(self, next_id):
+        # never lowered: ids handed out before stay retired
+        self._conn.execute(
+            "INSERT INTO meta (key, value) VALUES ('next_song_id', ?) "
+            "ON CONFLICT (key) DO UPDATE SET value = MAX(CAST(value AS INTEGER), CAST(excluded.value AS INTEGER))",
+            (str(next_id),),
+        )
+
+    def items(self):
+        """Yield (player, queue) for every stored queue."""
+        with self._lock:
+            rows = self._conn.execute('SELECT player, data FROM queues').fetchall()
+        for player, data in rows:
+            yield player, json.loads(data)
+
+    def player_states(self):
+        """Return [(player, mode, current)] for every saved player state."""
+        with self._lock:
+            return self._conn.execute('SELECT player, mode, current FROM player_state').fetchall()
+
+    def copy_from(self, other):
+        """Copy every queue and player state of ``other``; the caller commits."""
+        with self._lock:
+            self._conn.executemany(
+                'INSERT OR REPLACE INTO queues (player, data) VALUES (?, ?)',
+                [(player, _dump_json(queue)) for player, queue in other.items()],
+            )
+            self._conn.executemany(
+                'INSERT OR REPLACE INTO player_state (player, mode, current) VALUES (?, ?, ?)',
+                other.player_states(),
+            )
+
+    def load_queue(self, player):
+        with self._lock:
+            row = self._conn.execute('SELECT data FROM queues WHERE player = ?', (player,)).fetchone()
+        return json.loads(row[0]) if row else []
+
+    def save_queue(self, player, queue):
+        with self._lock, self._conn:
+            self._conn.execute('INSERT OR REPLACE INTO queues (player, data) VALUES (?, ?)', (player, _dump_json(queue)))
+
+    def has_queue(self, player):
+        with self._lock:
+            return self._conn.execute('SELECT 1 FROM queues WHERE player = ?', (player,)).fetchone() is not None
+
+    def delete(self, player):
+        """Forget the player's queue and saved state."""
+        with self._lock, self._conn:
+            self._conn.execute('DELETE FROM queues WHERE player = ?', (player,))
+            self._conn.execute('DELETE FROM player_state WHERE player = ?', (player,))
+
+    def load_player_state(self, player):
+        """(mode, current song id) saved when the player left, or None."""
+        with self._lock:
+            row = self._conn.execute('SELECT mode, current FROM player_state WHERE player = ?', (player,)).fetchone()
+        return tuple(row) if row else None
+
+    def save_player_state(self, player, mode, current):
+        with self._lock, self._conn:
+            if mode is None and current is None:
+                self._conn.execute('DELETE FROM player_state WHERE player = ?', (player,))
+            else:
+                self._conn.execute(
+                    'INSERT OR REPLACE INTO player_state (player, mode, current) VALUES (?, ?, ?)',
+                    (player, mode, current),
+                )
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+# duration is NUMERIC so whole seconds stay ints; extra holds unknown songs.json keys as JSON
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS songs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    name TEXT NOT NULL,
+    link TEXT NOT NULL,
+    artist TEXT NOT NULL,
+    duration NUMERIC,
+    extra TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_songs_link ON songs (link);
+CREATE INDEX IF NOT EXISTS idx_songs_name ON songs (name COLLATE NOCASE);
+CREATE TABLE IF NOT EXISTS song_artists (
+    song_id INTEGER NOT NULL REFERENCES songs (id) ON DELETE CASCADE,
+    artist TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_song_artists_artist ON song_artists (artist COLLATE NOCASE);
+CREATE INDEX IF NOT EXISTS idx_song_artists_song ON song_artists (song_id);
+"""
+
+_SONG_COLUMNS = 'id, name, link, artist, duration, extra'
+
+
+class SqliteBackend:
+    """Songs and queues in one SQLite database in WAL mode.
+
+    Library order is insertion order (``songs.id``), which every edit
+    preserves: add/copy append, del removes, set updates in place. The
+    row id is the song id; AUTOINCREMENT keeps ids of deleted rows retired.
+    Queues and player states are a :class:`QueueDatabase` on the same
+    connection.
+    """
+
+    name = 'sqlite'
+    paged = True
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self._rowids = []  # songs.id for each position of the last loaded list
+        self._lock = threading.RLock()
+        self._conn = _connect(db_path)
+        self._conn.execute('PRAGMA foreign_keys=ON')
+        self._conn.executescript(_SCHEMA)
+        columns = {row[1] for row in self._conn.execute('PRAGMA table_info(songs)')}
+        if 'extra' not in columns:  # databases created before songs kept their extra keys
+            self._conn.execute('ALTER TABLE songs ADD COLUMN extra TEXT')
+        self._conn.commit()
+        self.queues = QueueDatabase(db_path, self._conn, self._lock)
+
+    def migrate_from(self, json_backend):
+        """Import songs.json and the queue database once, on the first start with this backend."""
+        with self._lock:
+            done = self._conn.execute("SELECT value FROM meta WHERE key = 'migrated_json'").fetchone()
+            if done:
+                return False
+            songs = json_backend.load() if os.path.exists(json_backend.songs_path) else []
+            next_id = _assign_ids(songs, json_backend.next_id(), json_backend.known_ids())[1]
+            with self._conn:
+                for song in songs:
+                    self._insert(song)
+                if next_id > self.next_id():  # keep ids retired in songs.json retired here too
+                    updated = self._conn.execute("UPDATE sqlite_sequence SET seq = ? WHERE name = 'songs'", (next_id - 1,))
+                    if not updated.rowcount:
+                        self._conn.execute("INSERT INTO sqlite_sequence (name, seq) VALUES ('songs', ?)", (next_id - 1,))
+                self.queues.copy_from(json_backend.queues)
+                self._conn.execute("INSERT INTO meta (key, value) VALUES ('migrated_json', '1')")
+            return True
+
+    @staticmethod
+    def _row_to_song(row):
+        song_id, name, link, artist, duration, extra = row
+        return Song(name, link, json.loads(artist), duration, json.loads(extra) if extra else None, song_id)
+
+    def stamp(self):
+        """``PRAGMA data_version`` only moves when another connection commits."""
+        with self._lock:
+            return self._conn.execute('PRAGMA data_version').fetchone()[0]
+
+    def load(self):
+        with self._lock:
+            rows = self._conn.execute(f'SELECT {_SONG_COLUMNS} FROM songs ORDER BY id').fetchall()
+            self._rowids = [row[0] for row in rows]
+            return [self._row_to_song(row) for row in rows]
+
+    def next_id(self):
+        with self._lock:
+            row = self._conn.execute("SELECT seq FROM sqlite_sequence WHERE name = 'songs'").fetchone()
+        return (row[0] if row else 0) + 1
+
+    def known_ids(self):
+        """Rows keep their ids, so there is nothing to match songs against."""
+        return {}
+
+    def count(self):
+        with self._lock:
+            return self._conn.execute('SELECT COUNT(*) FROM songs').fetchone()[0]
+
+    def page(self, start, end):
+        with self._lock:
+            rows = self._conn.execute(
+                f'SELECT {_SONG_COLUMNS} FROM songs ORDER BY id LIMIT ? OFFSET ?',
+                (max(0, end - start), start),
+            ).fetchall()
+            return [self._row_to_song(row) for row in rows]
+
+    def _insert(self, song):
+        cur = self._conn.execute(
+            f'INSERT INTO songs ({_SONG_COLUMNS}) VALUES (?, ?, ?, ?, ?, ?)',
+            (song.id, song.name, song.link, _dump_json(list(song.artist)), song.duration,
+             _dump_json(song.extra) if song.extra else None),
+        )
+        self._conn.executemany(
+            'INSERT INTO song_artists (song_id, artist) VALUES (?, ?)',
+            [(cur.lastrowid, a) for a in song.artist],
+        )
+        return cur.lastrowid
+
+    def record(self, record):
+        op = record.get('op')
+        with self._lock, self._conn:
+            if op == 'add':
+                self._rowids.append(self._insert(Song.from_dict(record['song'])))
+            elif op == 'del':
+                self._conn.execute('DELETE FROM songs WHERE id = ?', (self._rowids.pop(record['index']),))
+            elif op == 'set':
+                rowid = self._rowids[record['index']]
+                extra = {}
+                for key, value in record['fields'].items():
+                    if key == 'artist':
+                        self._conn.execute('DELETE FROM song_artists WHERE song_id = ?', (rowid,))
+                        self._conn.executemany(
+                            'INSERT INTO song_artists (song_id, artist) VALUES (?, ?)',
+                            [(rowid, a) for a in value],
+                        )
+                        value = _dump_json(list(value))
+                    if key in ('name', 'link', 'artist', 'duration'):
+                        self._conn.execute(f'UPDATE songs SET {key} = ? WHERE id = ?', (value, rowid))
+                    else:
+                        extra[key] = value
+                if extra:
+                    row = self._conn.execute('SELECT extra FROM songs WHERE id = ?', (rowid,)).fetchone()
+                    merged = {**(json.loads(row[0]) if row and row[0] else {}), **extra}
+                    self._conn.execute('UPDATE songs SET extra = ? WHERE id = ?', (_dump_json(merged), rowid))
+        return False
+
+    def replace(self, songs):
+        with self._lock, self._conn:
+            self._conn.execute('DELETE FROM songs')
+            self._rowids = [self._insert(song) for song in songs]
+
+    def compact(self, songs):
+        pass
+
+    def flush(self, songs):
+        with self._lock:
+            self._conn.execute('PRAGMA wal_checkpoint(PASSIVE)')
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,82 @@
+"""Server tick rate estimation for lag-compensated auto-advance."""
+import re
+import time
+from collections import deque
+
+NORMAL_TPS = 20.0
+
+
+class TickRateMonitor:
+    """Estimates ticks per second from game time samples.
+
+    :meth:`sample` runs :data:`COMMAND` periodically; the server answers
+    with ``The time is <ticks>`` on its console, which :meth:`feed` parses.
+    The rate is game ticks elapsed over wall seconds elapsed across the
+    last ``window`` samples, clamped to ``[MIN_TPS, NORMAL_TPS]``.
+
+    ``time query daytime``/``day`` print the same line, so a reply is only
+    taken while a request is pending, and a game time that goes backwards
+    or advances faster than the server can tick is discarded.
+    """
+
+    COMMAND = 'time query gametime'
+    MIN_TPS = 1.0
+    MAX_SPEEDUP = 1.5     # a lagging server catches up a little faster than NORMAL_TPS
+    REPLY_TIMEOUT = 5.0   # seconds a request waits for its reply
+    _PATTERN = re.compile(r'The time is (\d+)\s*$')
+
+    def __init__(self, window=6, clock=time.monotonic):
+        self.clock = clock
+        self.samples = deque(maxlen=window)  # (wall time, game time)
+        self.tps = NORMAL_TPS
+        self.rejected = 0
+        self._requested = None  # wall time of the pending request
+
+    @property
+    def speed(self):
+        """Song seconds per wall second (1.0 at full speed)."""
+        return self.tps / NORMAL_TPS
+
+    def sample(self, server):
+        """Ask ``server`` for its game time if it is running; the reply comes through :meth:`feed`."""
+        if server.is_server_startup():
+            self._requested = self.clock()
+            server.execute(self.COMMAND)
+
+    def reset(self):
+        """Forget all samples (the server restarted, possibly with another world)."""
+        self.samples.clear()
+        self.tps = NORMAL_TPS
+        self._requested = None
+
+    def feed(self, text, now=None):
+        """Parse one line of server output; returns True if it was taken as a sample."""
+        if self._requested is None:
+            return False
+        m = self._PATTERN.search(text)
+        if m is None:
+            return False
+        now = self.clock() if now is None else now
+        if now - self._requested > self.REPLY_TIMEOUT:
+            self._requested = None
+            return False
+        if not self.observe(int(m.group(1)), now):
+            return False  # someone else's time query; keep waiting for ours
+        self._requested = None
+        return True
+
+    def observe(self, gametime, now=None):
+        """Add a sample; returns False if it is implausible and was discarded."""
+        now = self.clock() if now is None else now
+        if self.samples:
+            last_wall, last_game = self.samples[-1]
+            limit = (now - last_wall) * NORMAL_TPS * self.MAX_SPEEDUP + NORMAL_TPS
+            if not 0 <= gametime - last_game <= limit:
+                self.rejected += 1
+                return False
+        self.samples.append((now, gametime))
+        if len(self.samples) >= 2:
+            (w0, g0), (w1, g1) = self.samples[0], self.samples[-1]
+            if w1 > w0:
+                self.tps = min(NORMAL_TPS, max(self.MIN_TPS, (g1 - g0) / (w1 - w0)))
+        return True
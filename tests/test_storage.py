@@ -0,0 +1,61 @@
+import json
+import os
+
+from midiplayer.helpers import SongCatalog
+from midiplayer.song import Song
+from midiplayer.storage import JsonBackend, QueueDatabase
+
+
+def _open(tmp_path):
+    backend = JsonBackend(str(tmp_path / 'songs.json'), str(tmp_path / 'queues.db'))
+    return backend, SongCatalog(backend, compact_delay=0)
+
+
+def _ids(catalog):
+    return [(s.id, s.link) for s in catalog.songs()]
+
+
+def test_ids_survive_songs_json_regenerated_without_ids(tmp_path):
+    backend, catalog = _open(tmp_path)
+    for link in ('a:a', 'b:b', 'c:c', 'd:d'):
+        catalog.append(Song(link, link))
+    catalog.pop(2)
+    catalog.flush()
+    backend.close()
+    assert _ids(catalog) == [(1, 'a:a'), (2, 'b:b'), (4, 'd:d')]
+
+    # the CLI/GUI tool writes songs.json from scratch, without ids
+    songs = [{'name': link, 'link': link, 'artist': []} for link in ('z:z', 'a:a', 'b:b', 'd:d')]
+    with open(tmp_path / 'songs.json', 'w', encoding='utf-8') as f:
+        json.dump(songs, f)
+
+    backend, catalog = _open(tmp_path)
+    assert _ids(catalog) == [(5, 'z:z'), (1, 'a:a'), (2, 'b:b'), (4, 'd:d')]
+    catalog.append(Song('e:e', 'e:e'))
+    assert catalog.songs()[-1].id == 6  # 3 stays retired
+    backend.close()
+
+
+class FakeLogger:
+    def __init__(self):
+        self.warnings = []
+
+    def warning(self, msg):
+        self.warnings.append(msg)
+
+
+def test_import_dir_skips_corrupt_files(tmp_path):
+    queues_dir = tmp_path / 'queues'
+    queues_dir.mkdir()
+    (queues_dir / 'Alice.json').write_text('[1, 2]', encoding='utf-8')
+    (queues_dir / 'Bob.json').write_text('[3, 4', encoding='utf-8')  # truncated by a crash
+    db = QueueDatabase(str(tmp_path / 'queues.db'))
+
+    logger = FakeLogger()
+    assert db.import_dir(str(queues_dir), logger) == 1
+    assert len(logger.warnings) == 1 and 'Bob' in logger.warnings[0]
+    assert db.load_queue('Alice') == [1, 2]
+    assert not db.has_queue('Bob')
+    assert db.import_dir(str(queues_dir)) == 0  # marked done despite the bad file
+    db.close()
+    assert os.path.exists(queues_dir / 'Bob.json')
@@ -0,0 +1,110 @@
+from midiplayer.tickrate import NORMAL_TPS, TickRateMonitor
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 100.0
+
+    def __call__(self):
+        return self.now
+
+
+class FakeServer:
+    """Stands in for the server: counts game ticks and answers time queries."""
+
+    def __init__(self, clock, tps=NORMAL_TPS):
+        self.clock = clock
+        self.tps = tps
+        self.running = True
+        self.gametime = 5000
+        self.executed = []
+        self.replies = []
+
+    def is_server_startup(self):
+        return self.running
+
+    def execute(self, command):
+        self.executed.append(command)
+        if command == TickRateMonitor.COMMAND:
+            self.replies.append(f'[Server thread/INFO]: The time is {int(self.gametime)}')
+
+    def advance(self, seconds):
+        self.clock.now += seconds
+        self.gametime += seconds * self.tps
+
+
+def run(monitor, server, rounds, interval=5.0):
+    """The plugin's sampling loop: request, deliver the reply through feed(), wait."""
+    for _ in range(rounds):
+        monitor.sample(server)
+        while server.replies:
+            monitor.feed(server.replies.pop(0))
+        server.advance(interval)
+
+
+def make(tps=NORMAL_TPS):
+    clock = FakeClock()
+    return TickRateMonitor(clock=clock), FakeServer(clock, tps)
+
+
+def test_full_speed():
+    monitor, server = make()
+    run(monitor, server, 4)
+    assert server.executed == [TickRateMonitor.COMMAND] * 4
+    assert monitor.tps == NORMAL_TPS
+    assert monitor.speed == 1.0
+
+
+def test_lagging_server():
+    monitor, server = make(tps=10)
+    run(monitor, server, 4)
+    assert monitor.tps == 10
+    assert monitor.speed == 0.5
+
+
+def test_no_requests_while_server_is_down():
+    monitor, server = make()
+    server.running = False
+    run(monitor, server, 3)
+    assert server.executed == []
+    assert not monitor.samples
+
+
+def test_unsolicited_replies_are_ignored():
+    monitor, server = make(tps=10)
+    run(monitor, server, 2)
+    # an admin's `time query daytime` with no request of ours pending
+    assert not monitor.feed('[Server thread/INFO]: The time is 20000')
+    assert len(monitor.samples) == 2
+    assert monitor.tps == 10
+
+
+def test_foreign_reply_while_pending_is_discarded():
+    monitor, server = make(tps=10)
+    run(monitor, server, 2)
+    monitor.sample(server)
+    # daytime answer lands before ours: it goes backwards, so ours is still awaited
+    assert not monitor.feed('[Server thread/INFO]: The time is 12')
+    assert not monitor.feed('[Server thread/INFO]: The time is 999999')
+    assert monitor.feed(server.replies.pop())
+    assert monitor.rejected == 2
+    assert monitor.tps == 10
+
+
+def test_late_reply_is_dropped():
+    monitor, server = make()
+    monitor.sample(server)
+    server.advance(TickRateMonitor.REPLY_TIMEOUT + 1)
+    assert not monitor.feed(server.replies.pop())
+    assert not monitor.samples
+
+
+def test_reset_after_world_change():
+    monitor, server = make(tps=10)
+    run(monitor, server, 3)
+    server.gametime = 0
+    monitor.reset()
+    server.tps = NORMAL_TPS
+    run(monitor, server, 3)
+    assert monitor.tps == NORMAL_TPS
+    assert monitor.rejected == 0